@@ -1,6 +1,26 @@
+import asyncio
+import json
+import random
 import aiohttp
 from loguru import logger
-from typing import Optional, Dict, Any
+from typing import (
+    Optional,
+    Dict,
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Hashable,
+    Iterable,
+    List,
+)
+from .cache import TTLCache
+from .rate_limit import TokenBucket
+from .batcher import MicroBatcher
+
+
+# Статусы, при которых запрос имеет смысл повторить
+RETRY_STATUSES = {429, 500, 502, 503, 504}
 
 
 class AmoCRMClient:
@@ -13,6 +33,23 @@ class AmoCRMClient:
         redirect_uri: Optional[str] = None,
         refresh_token: Optional[str] = None,
         permanent_access_token: bool = False,
+        user_cache_size: int = 256,
+        user_cache_ttl: Optional[float] = 3600,
+        contact_cache_size: int = 1024,
+        contact_cache_ttl: Optional[float] = 60,
+        rate_limit: float = 7.0,
+        max_retries: int = 3,
+        backoff_base: float = 0.5,
+        backoff_max: float = 30.0,
+        connection_limit: int = 20,
+        keepalive_timeout: float = 75.0,
+        dns_cache_ttl: int = 300,
+        total_timeout: float = 30.0,
+        connect_timeout: float = 5.0,
+        read_timeout: float = 15.0,
+        batch_window: float = 0.05,
+        rate_limiter=None,
+        coordinator=None,
     ):
         self.base_url = base_url
         self.access_token = access_token
@@ -22,12 +59,66 @@ class AmoCRMClient:
         self.refresh_token = refresh_token
         self.permanent_access_token = permanent_access_token
         self.session: Optional[aiohttp.ClientSession] = None
+        self._users = TTLCache(user_cache_size, user_cache_ttl)
+        self._contacts = TTLCache(contact_cache_size, contact_cache_ttl)
+        # Запросы, которые уже выполняются: одновременные обращения к одной
+        # записи ждут один и тот же запрос
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+        # Общий для всех запросов ограничитель частоты (лимит AmoCRM ~7 запросов/с).
+        # При нескольких воркерах передается ведро, общее для всех процессов
+        self._rate_limiter = rate_limiter or TokenBucket(rate_limit)
+        # Общее состояние воркеров: обновление токена выполняет один процесс
+        self.coordinator = coordinator
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.retries = 0
+        self.status_counts: Dict[int, int] = {}
+        self.connection_limit = connection_limit
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        self.timeout = aiohttp.ClientTimeout(
+            total=total_timeout, connect=connect_timeout, sock_read=read_timeout
+        )
+        self._headers: Dict[str, str] = {}
+        self._update_headers()
+        # Одиночные запросы сделок и контактов, пришедшие почти одновременно,
+        # объединяются в один запрос с фильтром по `id`
+        self.batch_window = batch_window
+        self._lead_batcher = MicroBatcher(self.get_leads, batch_window)
+        self._contact_batcher = MicroBatcher(self.get_contacts, batch_window)
 
     def start_session(self) -> aiohttp.ClientSession:
-        """Создание aiohttp-сессии"""
+        """Создание aiohttp-сессии с пулом постоянных соединений"""
         if self.session is None:
-            self.session = aiohttp.ClientSession()
+            connector = aiohttp.TCPConnector(
+                limit=self.connection_limit,
+                limit_per_host=self.connection_limit,
+                keepalive_timeout=self.keepalive_timeout,
+                ttl_dns_cache=self.dns_cache_ttl,
+            )
+            self.session = aiohttp.ClientSession(
+                connector=connector, timeout=self.timeout
+            )
             logger.info("HTTP-сессия для AmoCRM создана.")
+        return self.session
+
+    async def warm_up(self) -> bool:
+        """Прогрев соединения: DNS и TLS-рукопожатие выполняются до первой сделки"""
+        try:
+            await self._make_request("GET", "/api/v4/account")
+            logger.info("Соединение с AmoCRM установлено.")
+            return True
+        except Exception as e:
+            logger.warning(f"Не удалось прогреть соединение с AmoCRM: {e}")
+            return False
+
+    def _update_headers(self):
+        """Обновление общих заголовков запросов (после смены токена)"""
+        self._headers = {
+            "Authorization": f"Bearer {self.access_token}",
+            "Content-Type": "application/json",
+        }
 
     async def close_session(self):
         """Явное закрытие aiohttp-сессии"""
@@ -40,42 +131,100 @@ class AmoCRMClient:
         self,
         method: str,
         endpoint: str,
-        params: Optional[Dict] = None,
+        params: Optional[Any] = None,
         data: Optional[Dict] = None,
     ):
         """Приватный метод для выполнения HTTP-запросов к AmoCRM API с обработкой ошибок и логированием"""
         url = f"{self.base_url}{endpoint}"
 
-        headers = {
-            "Authorization": f"Bearer {self.access_token}",
-            "Content-Type": "application/json",
-        }
-
+        # Параметры и тело форматируются только если уровень DEBUG включен
         logger.debug(
-            f"Отправка {method}-запроса на {url} с параметрами: {params} и данными: {data}"
+            "Отправка {}-запроса на {} с параметрами: {} и данными: {}",
+            method,
+            url,
+            params,
+            data,
         )
 
-        try:
-            async with self.session.request(
-                method, url, headers=headers, params=params, json=data
-            ) as response:
-                logger.info(
-                    f"Ответ от сервера: статус {response.status} для {method}-запроса на {url}"
+        token_refreshed = False
+        attempt = 0
+        while True:
+            await self._rate_limiter.acquire()
+            try:
+                async with self.session.request(
+                    method, url, headers=self._headers, params=params, json=data
+                ) as response:
+                    # Строка на каждый запрос: при нагрузке сохраняется каждая N-я
+                    logger.bind(sampled=True).info(
+                        "Ответ от сервера: статус {} для {}-запроса на {}",
+                        response.status,
+                        method,
+                        url,
+                    )
+                    self.status_counts[response.status] = (
+                        self.status_counts.get(response.status, 0) + 1
+                    )
+                    if (
+                        response.status == 401
+                        and not self.permanent_access_token
+                        and not token_refreshed
+                    ):  # Неавторизован — обновляем токен один раз, если токен не постоянный
+                        logger.warning("Токен истек, попытка обновления.")
+                        await self._refresh_access_token()
+                        token_refreshed = True
+                        continue
+                    if response.status in RETRY_STATUSES and attempt < self.max_retries:
+                        delay = self._retry_delay(
+                            attempt, response.headers.get("Retry-After")
+                        )
+                        if response.status == 429:
+                            # Притормаживаем все запросы клиента, а не только этот
+                            self._rate_limiter.pause(delay)
+                        logger.warning(
+                            f"Статус {response.status}, повтор через {delay:.2f} с"
+                        )
+                    else:
+                        response.raise_for_status()  # Генерируем исключение, если статус-код не 200-299
+                        if response.status == 204:  # Нет данных (например, пустой фильтр)
+                            return {}
+                        return await response.json()  # Возвращаем JSON ответ
+            except aiohttp.ClientResponseError as e:
+                logger.error(f"Ошибка запроса: {e.status} {e.message}")
+                raise
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if attempt >= self.max_retries:
+                    logger.error(f"Ошибка сети или соединения: {e}")
+                    raise
+                delay = self._retry_delay(attempt)
+                logger.warning(
+                    f"Ошибка сети или соединения: {e}, повтор через {delay:.2f} с"
                 )
-                if (
-                    response.status == 401 and not self.permanent_access_token
-                ):  # Неавторизован — обновляем токен, если токен не постоянный
-                    logger.warning("Токен истек, попытка обновления.")
-                    await self._refresh_access_token()
-                    return await self._make_request(method, endpoint, params, data)
-                response.raise_for_status()  # Генерируем исключение, если статус-код не 200-299
-                return await response.json()  # Возвращаем JSON ответ
-        except aiohttp.ClientResponseError as e:
-            logger.error(f"Ошибка запроса: {e.status} {e.message}")
-            raise
-        except aiohttp.ClientError as e:
-            logger.error(f"Ошибка сети или соединения: {e}")
-            raise
+            except aiohttp.ClientError as e:
+                logger.error(f"Ошибка сети или соединения: {e}")
+                raise
+            attempt += 1
+            self.retries += 1
+            await asyncio.sleep(delay)
+
+    def _retry_delay(self, attempt: int, retry_after: Optional[str] = None) -> float:
+        """Пауза перед повтором: `Retry-After` или экспоненциальная задержка с разбросом"""
+        if retry_after:
+            try:
+                return min(float(retry_after), self.backoff_max)
+            except ValueError:
+                pass
+        delay = min(self.backoff_base * 2**attempt, self.backoff_max)
+        return random.uniform(delay / 2, delay)
+
+    def request_stats(self) -> Dict[str, Any]:
+        """Статистика запросов: ожидание лимита, повторы и статусы ответов"""
+        return {
+            "rate_limit": self._rate_limiter.stats(),
+            "retries": self.retries,
+            "statuses": dict(self.status_counts),
+            "lead_batches": self._lead_batcher.stats(),
+            "contact_batches": self._contact_batcher.stats(),
+        }
 
     async def _refresh_access_token(self):
         """Приватный метод для обновления access_token с использованием refresh_token, если токен не постоянный"""
@@ -85,6 +234,36 @@ class AmoCRMClient:
             )
             return
 
+        if self.coordinator is not None:
+            async with self.coordinator.lock("amocrm_token"):
+                tokens = await self.coordinator.get("amocrm_token")
+                if tokens:
+                    tokens = json.loads(tokens)
+                    if tokens["access_token"] != self.access_token:
+                        # Другой воркер уже обновил токен — берем его
+                        self._set_tokens(tokens)
+                        logger.info("Токен обновлен другим воркером.")
+                        return
+                await self._request_tokens()
+                await self.coordinator.set(
+                    "amocrm_token",
+                    json.dumps(
+                        {
+                            "access_token": self.access_token,
+                            "refresh_token": self.refresh_token,
+                        }
+                    ),
+                )
+            return
+        await self._request_tokens()
+
+    def _set_tokens(self, tokens: Dict[str, str]):
+        self.access_token = tokens["access_token"]
+        self.refresh_token = tokens["refresh_token"]
+        self._update_headers()
+
+    async def _request_tokens(self):
+        """Запрос новой пары токенов по refresh_token"""
         url = f"{self.base_url}/oauth2/access_token"
         data = {
             "client_id": self.client_id,
@@ -99,9 +278,7 @@ class AmoCRMClient:
         try:
             async with self.session.post(url, json=data) as response:
                 if response.status == 200:
-                    tokens = await response.json()
-                    self.access_token = tokens["access_token"]
-                    self.refresh_token = tokens["refresh_token"]
+                    self._set_tokens(await response.json())
                     logger.info("Токен успешно обновлен.")
                 else:
                     logger.critical(
@@ -114,11 +291,166 @@ class AmoCRMClient:
 
     async def get_lead(self, id: int) -> Dict[Any, Any]:
         """Получение информации о сделке по `id`"""
+        if self.batch_window > 0:
+            return await self._lead_batcher.get(int(id))
         return await self._make_request("GET", f"/api/v4/leads/{id}?with=contacts")
 
+    async def _get_many(
+        self, entity: str, ids: Iterable[int], params: Optional[List] = None
+    ) -> Dict[int, Dict[Any, Any]]:
+        """Пакетное получение записей по списку `id` через фильтр `filter[id][]`"""
+        ids = list(dict.fromkeys(int(id) for id in ids))
+        result = {}
+        for start in range(0, len(ids), 250):
+            chunk = ids[start : start + 250]
+            data = await self._make_request(
+                "GET",
+                f"/api/v4/{entity}",
+                params=[("filter[id][]", id) for id in chunk]
+                + [("limit", 250)]
+                + (params or []),
+            )
+            for item in data.get("_embedded", {}).get(entity, []):
+                result[item["id"]] = item
+        return result
+
+    async def get_leads(self, ids: Iterable[int]) -> Dict[int, Dict[Any, Any]]:
+        """Получение нескольких сделок (с контактами) одним запросом"""
+        return await self._get_many("leads", ids, [("with", "contacts")])
+
+    async def get_contacts(self, ids: Iterable[int]) -> Dict[int, Dict[Any, Any]]:
+        """Получение нескольких контактов одним запросом"""
+        contacts = await self._get_many("contacts", ids)
+        for id, contact in contacts.items():
+            self._contacts.set(("contact", id), contact)
+        return contacts
+
+    async def iter_lead_pages(
+        self,
+        params: Optional[List] = None,
+        start_page: int = 1,
+        limit: int = 250,
+    ) -> AsyncIterator[tuple[int, List[Dict[Any, Any]]]]:
+        """Постраничный обход сделок (с контактами) в порядке возрастания `id`.
+
+        Отдает пары (номер страницы, сделки); `params` — дополнительные
+        фильтры, например `[("filter[closed_at][from]", 1727740800)]`.
+        """
+        page = start_page
+        while True:
+            data = await self._make_request(
+                "GET",
+                "/api/v4/leads",
+                params=[
+                    ("page", page),
+                    ("limit", limit),
+                    ("with", "contacts"),
+                    ("order[id]", "asc"),
+                ]
+                + (params or []),
+            )
+            leads = data.get("_embedded", {}).get("leads", [])
+            if leads:
+                yield page, leads
+            if not leads or "next" not in data.get("_links", {}):
+                return
+            page += 1
+
+    async def iter_events(
+        self,
+        types: Iterable[str],
+        created_from: int,
+        created_to: Optional[int] = None,
+        limit: int = 100,
+    ) -> AsyncIterator[List[Dict[Any, Any]]]:
+        """Постраничный обход событий аккаунта (`/api/v4/events`).
+
+        `types` — типы событий, например `lead_status_changed`; границы
+        `created_from`/`created_to` — unix-время, включительно.
+        """
+        params = [
+            ("filter[type]", ",".join(types)),
+            ("filter[created_at][from]", created_from),
+            ("limit", limit),
+        ]
+        if created_to is not None:
+            params.append(("filter[created_at][to]", created_to))
+        page = 1
+        while True:
+            data = await self._make_request(
+                "GET", "/api/v4/events", params=[("page", page)] + params
+            )
+            events = data.get("_embedded", {}).get("events", [])
+            if events:
+                yield events
+            if not events or "next" not in data.get("_links", {}):
+                return
+            page += 1
+
+    async def get_users(self, ids: Iterable[int]) -> Dict[int, Dict[Any, Any]]:
+        """Получение нескольких пользователей (в основном из кэша)"""
+        ids = list(dict.fromkeys(int(id) for id in ids))
+        users = await asyncio.gather(*(self.get_user(id) for id in ids))
+        return dict(zip(ids, users))
+
+    async def _cached(
+        self,
+        cache: TTLCache,
+        key: Hashable,
+        fetch: Callable[[], Awaitable[Dict[Any, Any]]],
+    ) -> Dict[Any, Any]:
+        """Возвращает запись из кэша или запрашивает ее.
+
+        Одновременные запросы одной и той же записи объединяются в один.
+        """
+        found, value = cache.get(key)
+        if found:
+            return value
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(fetch())
+            self._inflight[key] = future
+            future.add_done_callback(lambda _: self._inflight.pop(key, None))
+        value = await asyncio.shield(future)
+        cache.set(key, value)
+        return value
+
     async def get_user(self, id: int) -> Dict[Any, Any]:
         """Получение инофрмации о пользователе по `id`"""
-        return await self._make_request("GET", f"/api/v4/users/{id}")
+        return await self._cached(
+            self._users,
+            ("user", id),
+            lambda: self._make_request("GET", f"/api/v4/users/{id}"),
+        )
 
     async def get_contact(self, id: int):
-        return await self._make_request("GET", f"/api/v4/contacts/{id}")
+        return await self._cached(
+            self._contacts,
+            ("contact", id),
+            lambda: (
+                self._contact_batcher.get(int(id))
+                if self.batch_window > 0
+                else self._make_request("GET", f"/api/v4/contacts/{id}")
+            ),
+        )
+
+    async def prefetch_users(self) -> int:
+        """Загрузка в кэш всех пользователей аккаунта, возвращает их количество"""
+        page, count = 1, 0
+        while True:
+            data = await self._make_request(
+                "GET", "/api/v4/users", params={"page": page, "limit": 250}
+            )
+            users = (data or {}).get("_embedded", {}).get("users", [])
+            for user in users:
+                self._users.set(("user", user["id"]), user)
+            count += len(users)
+            if not users or "next" not in data.get("_links", {}):
+                break
+            page += 1
+        logger.info(f"Пользователи AmoCRM загружены в кэш: {count}")
+        return count
+
+    def cache_stats(self) -> Dict[str, dict]:
+        """Статистика попаданий в кэш пользователей и контактов"""
+        return {"users": self._users.stats(), "contacts": self._contacts.stats()}
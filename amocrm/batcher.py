@@ -0,0 +1,72 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Set
+
+
+class MicroBatcher:
+    """Объединяет одиночные запросы в пакетные.
+
+    Ключи, запрошенные в течение `window` секунд (но не больше `max_size`),
+    передаются одним вызовом `fetch_many`, который возвращает словарь
+    «ключ → запись». Повторный запрос уже ожидающего ключа не добавляет его
+    в пакет второй раз.
+    """
+
+    def __init__(
+        self,
+        fetch_many: Callable[[List[Hashable]], Awaitable[Dict[Hashable, Any]]],
+        window: float = 0.05,
+        max_size: int = 250,
+    ):
+        self.fetch_many = fetch_many
+        self.window = window
+        self.max_size = max_size
+        self._pending: Dict[Hashable, asyncio.Future] = {}
+        self._timer: Optional[asyncio.TimerHandle] = None
+        # Ссылки на запущенные запросы, чтобы их не собрал сборщик мусора
+        self._tasks: Set[asyncio.Task] = set()
+        self.batches = 0
+        self.keys = 0
+
+    async def get(self, key: Hashable) -> Any:
+        """Возвращает запись по ключу, дождавшись ближайшего пакетного запроса"""
+        loop = asyncio.get_running_loop()
+        future = self._pending.get(key)
+        if future is None:
+            future = loop.create_future()
+            self._pending[key] = future
+        if len(self._pending) >= self.max_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        return await asyncio.shield(future)
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, {}
+        if batch:
+            task = asyncio.ensure_future(self._run(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch: Dict[Hashable, asyncio.Future]):
+        self.batches += 1
+        self.keys += len(batch)
+        try:
+            results = await self.fetch_many(list(batch))
+        except Exception as e:
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for key, future in batch.items():
+            if future.done():
+                continue
+            if key in results:
+                future.set_result(results[key])
+            else:
+                future.set_exception(LookupError(f"Запись {key} не найдена"))
+
+    def stats(self) -> dict:
+        return {"batches": self.batches, "keys": self.keys}
@@ -0,0 +1,47 @@
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional, Tuple
+
+
+class TTLCache:
+    """LRU-кэш с ограничением размера и временем жизни записей.
+
+    При переполнении вытесняется запись, к которой дольше всего не
+    обращались. Если `ttl` не задан, записи не устаревают.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> Tuple[bool, Any]:
+        """Возвращает пару (найдено, значение)"""
+        item = self._data.get(key)
+        if item is not None:
+            expires_at, value = item
+            if expires_at >= time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return True, value
+            del self._data[key]
+        self.misses += 1
+        return False, None
+
+    def set(self, key: Hashable, value: Any):
+        expires_at = time.monotonic() + self.ttl if self.ttl else float("inf")
+        self._data[key] = (expires_at, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key: Hashable):
+        self._data.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> dict:
+        return {"size": len(self._data), "hits": self.hits, "misses": self.misses}
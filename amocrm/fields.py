@@ -0,0 +1,142 @@
+from datetime import datetime, timedelta
+from functools import lru_cache
+from typing import Any, Callable, Dict, NamedTuple, Optional
+from loguru import logger
+
+
+def _first(field: dict) -> Any:
+    """Первое значение поля"""
+    value = field["values"][0]["value"]
+    return value if value is not None else ""
+
+
+def _all(field: dict) -> str:
+    """Все значения поля через запятую (для полей с множественным выбором)"""
+    return ", ".join(
+        [value["value"] for value in field["values"] if value["value"] is not None]
+    )
+
+
+@lru_cache(maxsize=4096)
+def _date_from_timestamp(timestamp: int) -> str:
+    # В AmoCRM даты хранятся на полночь предыдущего дня, поэтому прибавляем день
+    return (datetime.fromtimestamp(timestamp) + timedelta(days=1)).strftime(
+        "%Y-%m-%d"
+    )
+
+
+def _date(field: dict) -> str:
+    """Дата из timestamp в формате `YYYY-MM-DD`"""
+    value = _first(field)
+    return _date_from_timestamp(int(value)) if value != "" else ""
+
+
+class FieldSpec(NamedTuple):
+    """Описание пользовательского поля сделки.
+
+    `target` — атрибут сделки (`branch`) или вложенного объекта
+    (`learner.first_name`), `field_id` — `id` поля в AmoCRM, если известен.
+    """
+
+    name: str
+    target: str
+    convert: Callable[[dict], Any] = _first
+    field_id: Optional[int] = None
+
+
+# Пользовательские поля вкладки «Основное», которые переносятся в сделку
+LEAD_FIELDS = (
+    FieldSpec("Имя ученика", "learner.first_name"),
+    FieldSpec("Фамилия ученика", "learner.last_name"),
+    FieldSpec("Класс", "learner.grade"),
+    FieldSpec("Отделение", "learner.departament"),
+    FieldSpec("Статус Ученика", "status", _all),
+    FieldSpec("Цель обучения", "learner.learning_direction"),
+    FieldSpec("Предметы", "learner.profile_subjects", _all),
+    FieldSpec("Коммент ОП", "manager.comment"),
+    FieldSpec("ФИО родителя", "parent.name"),
+    FieldSpec("Дата 1 транша", "payment.date", _date),
+    FieldSpec("Город?", "city"),
+    FieldSpec("Сумма 1 транша", "payment.amount"),
+    FieldSpec("Сумма 2 транша", "payment.credit"),
+    FieldSpec("Метод Оплаты", "payment.method"),
+    FieldSpec("Филиал", "branch"),
+    FieldSpec("Срок обуч (мес)", "learning_duration"),
+    FieldSpec("Дата начала учебы по договору", "start_date", _date),
+    FieldSpec("Дата конца учебы", "end_date", _date),
+    FieldSpec("Время обучения", "learning_time"),
+    FieldSpec("Номер телефона родителя", "parent.phone"),
+    FieldSpec("Баз-й курс (мес)", "base_course"),
+    FieldSpec("Летний лагерь", "summer_camp"),
+    FieldSpec("Инт-й курс (мес)", "intensive_cource"),
+)
+
+
+Handler = Callable[[Any, dict], None]
+
+
+def _compile(spec: FieldSpec) -> Handler:
+    """Собирает функцию, которая записывает значение поля в сделку"""
+    owner, _, attr = spec.target.rpartition(".")
+    convert = spec.convert
+
+    def apply(lead, field: dict):
+        try:
+            value = convert(field)
+        except (KeyError, IndexError, TypeError) as e:
+            logger.warning(f"Ошибка при обработке поля `{spec.name}`: {e}")
+            value = ""
+        setattr(getattr(lead, owner) if owner else lead, attr, value)
+
+    return apply
+
+
+class FieldRegistry:
+    """Таблица разбора пользовательских полей сделки.
+
+    Поле ищется по `field_id`, а если он неизвестен — по названию. Найденный
+    по названию `field_id` запоминается, поэтому дальше поиск идет по `id`
+    и переименование поля в AmoCRM не ломает разбор.
+    """
+
+    def __init__(self, specs=LEAD_FIELDS):
+        self._by_name: Dict[str, Handler] = {}
+        self._by_id: Dict[int, Handler] = {}
+        self._specs: Dict[str, FieldSpec] = {}
+        for spec in specs:
+            handler = _compile(spec)
+            self._by_name[spec.name] = handler
+            self._specs[spec.name] = spec
+            if spec.field_id is not None:
+                self._by_id[spec.field_id] = handler
+
+    def handler(self, field: dict) -> Optional[Handler]:
+        """Возвращает обработчик поля или `None`, если поле не нужно"""
+        field_id = field.get("field_id")
+        handler = self._by_id.get(field_id)
+        if handler is None:
+            handler = self._by_name.get(field.get("field_name"))
+            if handler is not None and field_id is not None:
+                self._by_id[field_id] = handler
+        return handler
+
+    def value(self, fields: list, name: str) -> Any:
+        """Значение одного поля без разбора остальных (`""`, если поля нет)"""
+        target = self._by_name[name]
+        for field in fields:
+            if self.handler(field) is target:
+                try:
+                    return self._specs[name].convert(field)
+                except (KeyError, IndexError, TypeError):
+                    return ""
+        return ""
+
+    def apply(self, lead, fields: list):
+        """Записывает значения всех известных полей в сделку за один проход"""
+        for field in fields:
+            handler = self.handler(field)
+            if handler is not None:
+                handler(lead, field)
+
+
+lead_fields = FieldRegistry()
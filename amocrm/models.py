@@ -1,8 +1,12 @@
 from loguru import logger
-from datetime import datetime, timedelta
-from typing import Optional
+from dataclasses import dataclass, field
+from datetime import datetime
+from operator import attrgetter
+from typing import Any, Callable, Optional, Tuple, Union
+from .fields import lead_fields
 
 
+@dataclass(slots=True)
 class Learner:
     first_name: str = ""  # Имя ученика
     last_name: str = ""  # Фамилия ученика
@@ -22,6 +26,7 @@ class Learner:
         )
 
 
+@dataclass(slots=True)
 class Manager:
     id: Optional[int] = None
     name: str = ""
@@ -40,11 +45,14 @@ class Manager:
         )
 
 
+@dataclass(slots=True)
 class Payment:
+    # Суммы и метод хранятся как значения полей AmoCRM (обычно строки);
+    # в числа суммы переводятся при записи в таблицу (`prepare_row`)
     date: str = ""
-    amount: int = 0
-    credit: int = 0
-    method: int = 0
+    amount: Union[int, str] = 0
+    credit: Union[int, str] = 0
+    method: Union[int, str] = 0
 
     def __str__(self):
         """Возвращает строковое представление оплаты"""
@@ -61,6 +69,13 @@ class BranchIsNotOnline(Exception):
     pass
 
 
+def is_online(data: dict) -> bool:
+    """Быстрая проверка филиала сделки без разбора остальных полей"""
+    fields = data.get("custom_fields_values") or []
+    return lead_fields.value(fields, "Филиал") == "Онлайн"
+
+
+@dataclass(slots=True)
 class Parent:
     id: Optional[int] = None
     name: str = ""
@@ -71,9 +86,9 @@ class Parent:
         # if not (self.name == data.get("name", "None")):
         #     return
         email = None
-        for field in data.get("custom_fields_values", []):
-            if field["field_name"] == "Email":
-                email = field["values"][0]["value"]
+        for custom_field in data.get("custom_fields_values", []):
+            if custom_field["field_name"] == "Email":
+                email = custom_field["values"][0]["value"]
                 break
         self.email = email if email else ""
 
@@ -87,65 +102,43 @@ class Parent:
         )
 
 
+@dataclass(slots=True)
 class Lead:
-    def __init__(self, id: int):
-        """
-        Инициализация объекта Order.
-
-        :param id: Идентификатор заказа
-        """
-        self.id = id  # Уникальный идентификатор заказа
-
-        # Ученик
-        self.learner: Learner = Learner()
-
-        # Объект менеджера
-        self.manager: Manager = Manager()
-
-        # Оплата
-        self.payment = Payment()
-
-        # Информация о родителе
-        self.parent: Parent = Parent()  # родитель
-
-        # Дополнительные данные о заказе
-        self.city: str = ""  # Город
-        self.branch: str = ""  # Филиал
-        self.learning_duration: str = ""  # Срок обучения
-        self.start_date: str = ""  # Дата начала обучения
-        self.end_date: str = ""  # Дата окончания обучения
-        self.learning_time: str = ""  # Время обучения
-        self.phone: str = ""  # Телефон
-        self.email = ""  # Почта
-        self.base_course = ""
-        self.intensive_cource = ""
-        self.summer_camp = ""
-        self.status: str = ""  # Статус лида
-
-    def __get_value_from_json(self, field: dict, _all: bool = False) -> str:
-        """Приватный метод для получения значения из JSON"""
-        try:
-            if not _all:
-                value = (
-                    field["values"][0]["value"]
-                    if field["values"][0]["value"] is not None
-                    else ""
-                )
-            else:
-                value = ", ".join(
-                    [
-                        value["value"]
-                        for value in field["values"]
-                        if value["value"] is not None
-                    ]
-                )
-            logger.debug(f"{field.get('field_name','Неизвестное')}: {value}")
-            return value
-        except (KeyError, IndexError, TypeError) as e:
-            logger.warning(
-                f"Ошибка при обработке поля `{field.get('field_name','Неизвестное')}`: {e}"
-            )
-            return ""
+    id: int  # Уникальный идентификатор заказа
+
+    # Ученик
+    learner: Learner = field(default_factory=Learner)
+
+    # Объект менеджера
+    manager: Manager = field(default_factory=Manager)
+
+    # Оплата
+    payment: Payment = field(default_factory=Payment)
+
+    # Информация о родителе
+    parent: Parent = field(default_factory=Parent)  # родитель
+
+    # Дополнительные данные о заказе
+    city: str = ""  # Город
+    branch: str = ""  # Филиал
+    learning_duration: str = ""  # Срок обучения
+    start_date: str = ""  # Дата начала обучения
+    end_date: str = ""  # Дата окончания обучения
+    learning_time: str = ""  # Время обучения
+    phone: str = ""  # Телефон
+    email: str = ""  # Почта
+    base_course: str = ""
+    intensive_cource: str = ""
+    summer_camp: str = ""
+    status: str = ""  # Статус лида
+
+    def to_row(self) -> Tuple[Any, ...]:
+        """Строка для Google Таблицы в порядке `SHEET_COLUMNS`"""
+        return tuple(getter(self) for getter in _ROW_GETTERS)
+
+    def telegram_payload(self) -> dict:
+        """Значения для шаблона сообщения в Telegram"""
+        return {name: getter(self) for name, getter in TELEGRAM_FIELDS.items()}
 
     @classmethod
     def from_json(cls, data: dict) -> "Lead":
@@ -153,109 +146,7 @@ class Lead:
         try:
             self: Lead = cls(data.get("id", ""))
             self.manager.id = data.get("responsible_user_id", None)
-            for field in data.get("custom_fields_values", []):
-                match field.get("field_name", None):
-                    case None:
-                        continue
-
-                    case "Имя ученика":
-                        self.learner.first_name = self.__get_value_from_json(field)
-
-                    case "Фамилия ученика":
-                        self.learner.last_name = self.__get_value_from_json(field)
-
-                    case "Класс":
-                        self.learner.grade = self.__get_value_from_json(field)
-
-                    case "Отделение":
-                        self.learner.departament = self.__get_value_from_json(field)
-
-                    case "Статус Ученика":
-                        self.status = self.__get_value_from_json(field, _all=True)
-
-                    case "Цель обучения":
-                        self.learner.learning_direction = self.__get_value_from_json(
-                            field
-                        )
-
-                    case "Предметы":
-                        self.learner.profile_subjects = self.__get_value_from_json(
-                            field, _all=True
-                        )
-
-                    case "Коммент ОП":
-                        self.manager.comment = self.__get_value_from_json(field)
-
-                    case "ФИО родителя":
-                        self.parent.name = self.__get_value_from_json(field)
-
-                    case "Дата 1 транша":
-                        date = self.__get_value_from_json(field)
-                        if date != "":
-                            date = (
-                                datetime.fromtimestamp(
-                                    int(self.__get_value_from_json(field))
-                                )
-                                + timedelta(days=1)
-                            ).strftime("%Y-%m-%d")
-                        self.payment.date = date
-
-                    case "Город?":
-                        self.city = self.__get_value_from_json(field)
-
-                    case "Сумма 1 транша":
-                        self.payment.amount = self.__get_value_from_json(field)
-
-                    case "Сумма 2 транша":
-                        self.payment.credit = self.__get_value_from_json(field)
-
-                    case "Метод Оплаты":
-                        self.payment.method = self.__get_value_from_json(field)
-
-                    case "Филиал":
-                        self.branch = self.__get_value_from_json(field)
-
-                    case "Срок обуч (мес)":
-                        self.learning_duration = self.__get_value_from_json(field)
-
-                    case "Дата начала учебы по договору":
-                        date = self.__get_value_from_json(field)
-                        if date != "":
-                            date = (
-                                datetime.fromtimestamp(
-                                    int(self.__get_value_from_json(field))
-                                )
-                                + timedelta(days=1)
-                            ).strftime("%Y-%m-%d")
-                        self.start_date = date
-
-                    case "Дата конца учебы":
-                        date = self.__get_value_from_json(field)
-                        if date != "":
-                            date = (
-                                datetime.fromtimestamp(
-                                    int(self.__get_value_from_json(field))
-                                )
-                                + timedelta(days=1)
-                            ).strftime("%Y-%m-%d")
-                        self.end_date = date
-
-                    case "Время обучения":
-                        self.learning_time = self.__get_value_from_json(field)
-
-                    case "Номер телефона родителя":
-                        self.parent.phone = self.__get_value_from_json(field)
-
-                    case "Баз-й курс (мес)":
-                        self.base_course = self.__get_value_from_json(field)
-
-                    case "Летний лагерь":
-                        self.summer_camp = self.__get_value_from_json(field)
-
-                    case "Инт-й курс (мес)":
-                        self.intensive_cource = self.__get_value_from_json(field)
-                    case _:
-                        pass
+            lead_fields.apply(self, data.get("custom_fields_values") or [])
             if self.branch != "Онлайн":
                 raise BranchIsNotOnline(f"Филиал не онлайн")
             try:
@@ -293,3 +184,73 @@ class Lead:
             f"Летний лагерь: {self.summer_camp}\n"
             f"{self.payment}\n"
         )
+
+
+def _empty(lead: Lead) -> str:
+    return ""
+
+
+def _now(lead: Lead) -> str:
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+def _learner_full_name(lead: Lead) -> str:
+    return lead.learner.last_name + " " + lead.learner.first_name
+
+
+def _learning_duration(lead: Lead) -> str:
+    return "" if lead.learning_duration == "" else lead.learning_duration + " мес."
+
+
+# Колонки Google Таблицы: заголовок и функция получения значения из сделки
+SHEET_COLUMNS: Tuple[Tuple[str, Callable[[Lead], Any]], ...] = (
+    ("Дата внесения", _now),
+    ("Дата оплаты", attrgetter("payment.date")),
+    ("Менеджер", attrgetter("manager.name")),
+    ("", _empty),
+    ("Ученик", _learner_full_name),
+    ("Направление обучения", attrgetter("learner.learning_direction")),
+    ("Класс", attrgetter("learner.grade")),
+    ("Отделение", attrgetter("learner.departament")),
+    ("Время обучения", attrgetter("learning_time")),
+    ("Филиал", attrgetter("branch")),
+    ("Профильные предметы", attrgetter("learner.profile_subjects")),
+    ("Сумма 1 транша", attrgetter("payment.amount")),
+    ("Сумма 2 транша", attrgetter("payment.credit")),
+    ("Метод оплаты", attrgetter("payment.method")),
+    ("Баз-й курс (мес)", attrgetter("base_course")),
+    ("Инт-й курс (мес)", attrgetter("intensive_cource")),
+    ("Летний лагерь", attrgetter("summer_camp")),
+    ("Новый или продление", attrgetter("status")),
+    ("", _empty),
+    ("Дата начала обучения", attrgetter("start_date")),
+    ("Дата конца обучения", attrgetter("end_date")),
+    ("Родитель", attrgetter("parent.name")),
+    ("", _empty),
+    ("Телефон", attrgetter("parent.phone")),
+    ("Комментарий ОП", attrgetter("manager.comment")),
+    ("Email", attrgetter("parent.email")),
+    ("ID сделки", attrgetter("id")),
+)
+_ROW_GETTERS = tuple(getter for _, getter in SHEET_COLUMNS)
+
+# Поля сообщения в Telegram
+TELEGRAM_FIELDS = {
+    "payment_date": attrgetter("payment.date"),
+    "learner_last_name": attrgetter("learner.last_name"),
+    "learner_first_name": attrgetter("learner.first_name"),
+    "grade": attrgetter("learner.grade"),
+    "departament": attrgetter("learner.departament"),
+    "learning_time": attrgetter("learning_time"),
+    "parent_name": attrgetter("parent.name"),
+    "parent_phone": attrgetter("parent.phone"),
+    "branch": attrgetter("branch"),
+    "learning_duration": _learning_duration,
+    "start_date": attrgetter("start_date"),
+    "end_date": attrgetter("end_date"),
+    "learning_direction": attrgetter("learner.learning_direction"),
+    "profile_subjects": attrgetter("learner.profile_subjects"),
+    "status": attrgetter("status"),
+    "manager_comment": attrgetter("manager.comment"),
+    "manager_name": attrgetter("manager.name"),
+}
@@ -0,0 +1,60 @@
+import asyncio
+import time
+from typing import Optional
+
+
+class TokenBucket:
+    """Ограничитель частоты запросов по алгоритму «ведро с токенами».
+
+    Один экземпляр разделяется всеми запросами клиента: ожидающие получают
+    токены строго по очереди, поэтому общая частота не превышает `rate`
+    запросов в секунду, а кратковременные всплески — `capacity` запросов.
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+        self.acquired = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(
+            self.capacity, self._tokens + (now - self._updated_at) * self.rate
+        )
+        self._updated_at = now
+
+    async def acquire(self) -> float:
+        """Ждет токен и возвращает время ожидания в секундах"""
+        started = time.monotonic()
+        async with self._lock:
+            self._refill()
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                self._refill()
+            self._tokens -= 1
+        waited = time.monotonic() - started
+        self.acquired += 1
+        self.total_wait += waited
+        if waited > self.max_wait:
+            self.max_wait = waited
+        return waited
+
+    def pause(self, delay: float):
+        """Не выдавать токены ближайшие `delay` секунд (например, после 429)"""
+        self._refill()
+        self._tokens = min(self._tokens, 1 - delay * self.rate)
+
+    def stats(self) -> dict:
+        return {
+            "acquired": self.acquired,
+            "avg_wait_ms": (
+                round(self.total_wait / self.acquired * 1000, 2) if self.acquired else 0.0
+            ),
+            "max_wait_ms": round(self.max_wait * 1000, 2),
+            "total_wait_s": round(self.total_wait, 3),
+        }
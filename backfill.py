@@ -0,0 +1,226 @@
+"""Догрузка сделок из AmoCRM за период в Google Таблицу (и при желании в Telegram).
+
+Сделки читаются постранично через `/api/v4/leads`, уже записанные в таблицу
+пропускаются, новые записываются пачками. После каждой страницы прогресс
+сохраняется в файл, поэтому прерванную догрузку можно продолжить.
+
+    python backfill.py --from 2024-10-01 --to 2024-10-31
+    python backfill.py --from 2024-10-01 --pipeline-id 7000001 --status-id 142 --telegram
+"""
+
+import argparse
+import asyncio
+import json
+import os
+from datetime import datetime
+from typing import Any, AsyncIterator, List, Optional, Tuple
+from aiogram import Bot
+from dotenv import load_dotenv
+from loguru import logger
+from amocrm import AmoCRMClient
+from amocrm.models import Lead, is_online
+from google_sheets import GoogleSheets
+from sheet_mirror import SheetMirror
+from sheet_writer import SheetWriter
+from telegram_sender import TelegramDispatcher
+
+
+class Checkpoint:
+    """Прогресс догрузки: следующая страница для заданного набора фильтров"""
+
+    def __init__(self, path: str, params: List[Tuple[str, Any]]):
+        self.path = path
+        self.key = json.dumps(params, ensure_ascii=False)
+        self.page = 1
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                state = json.load(f)
+            if state.get("key") == self.key:
+                self.page = state["page"]
+                logger.info(f"Продолжение догрузки со страницы {self.page}")
+
+    def save(self, page: int):
+        self.page = page
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"key": self.key, "page": page}, f)
+        os.replace(tmp_path, self.path)
+
+
+def build_params(args) -> List[Tuple[str, Any]]:
+    """Фильтры `/api/v4/leads` по аргументам командной строки"""
+    params = []
+    if args.date_from:
+        params.append(
+            (
+                f"filter[{args.field}][from]",
+                int(datetime.fromisoformat(args.date_from).timestamp()),
+            )
+        )
+    if args.date_to:
+        params.append(
+            (
+                f"filter[{args.field}][to]",
+                int(datetime.fromisoformat(args.date_to).timestamp()) + 86399,
+            )
+        )
+    if args.pipeline_id and args.status_id:
+        params.append(("filter[statuses][0][pipeline_id]", args.pipeline_id))
+        params.append(("filter[statuses][0][status_id]", args.status_id))
+    elif args.pipeline_id:
+        params.append(("filter[pipeline_id]", args.pipeline_id))
+    return params
+
+
+async def prefetched(
+    pages: AsyncIterator[Tuple[int, List[dict]]], depth: int
+) -> AsyncIterator[Tuple[int, List[dict]]]:
+    """Загружает до `depth` следующих страниц, пока обрабатывается текущая"""
+    queue: asyncio.Queue[Optional[Tuple[int, List[dict]]]] = asyncio.Queue(
+        maxsize=depth
+    )
+
+    async def produce():
+        try:
+            async for page in pages:
+                await queue.put(page)
+        finally:
+            await queue.put(None)
+
+    producer = asyncio.create_task(produce())
+    try:
+        while (item := await queue.get()) is not None:
+            yield item
+        await producer  # Пробрасываем ошибку загрузки, если она была
+    finally:
+        producer.cancel()
+
+
+async def enrich(amo_client: AmoCRMClient, leads: List[Lead]):
+    """Менеджеры (из кэша) и контакты страницы — одним пакетом"""
+    users, contacts = await asyncio.gather(
+        amo_client.get_users({lead.manager.id for lead in leads if lead.manager.id}),
+        amo_client.get_contacts({lead.parent.id for lead in leads if lead.parent.id}),
+    )
+    for lead in leads:
+        if lead.manager.id in users:
+            lead.manager.set_name(users[lead.manager.id])
+        if lead.parent.id in contacts:
+            lead.parent.set_email(contacts[lead.parent.id])
+
+
+async def backfill(args):
+    load_dotenv()
+    params = build_params(args)
+    checkpoint = Checkpoint(args.checkpoint, params)
+
+    amo_client = AmoCRMClient(
+        base_url=os.getenv("amocrm_url", "https://teslakz.amocrm.ru"),
+        access_token=os.getenv("access_token"),
+        client_id=os.getenv("client_id"),
+        client_secret=os.getenv("client_secret"),
+        permanent_access_token=True,
+        batch_window=0,
+    )
+    amo_client.start_session()
+    google = GoogleSheets(
+        mirror=SheetMirror(args.mirror),
+        shard_by=os.getenv("sheet_shard_by", ""),
+        max_rows=int(os.getenv("sheet_max_rows", "0")),
+    )
+    sheet_writer = SheetWriter(google, flush_interval=0.5, max_batch=250)
+    sheet_writer.start()
+    bot = Bot(os.getenv("telegram_token")) if args.telegram else None
+    telegram = TelegramDispatcher(bot) if bot else None
+    group_chat_id = int(os.getenv("group")) if bot else None
+
+    # Уже записанные сделки: по id, а в старых строках без id — по телефону и дате
+    for title in google.sheet_titles():
+        google.sync(sheet=title)
+    lead_ids, pairs = google.mirror.existing_keys()
+    logger.info(f"В таблице уже есть сделок: {len(lead_ids) + len(pairs)}")
+    written = skipped = failed = 0
+    try:
+        await amo_client.prefetch_users()
+        pages = amo_client.iter_lead_pages(params, start_page=checkpoint.page)
+        async for page, data in prefetched(pages, args.concurrency):
+            leads = []
+            for item in data:
+                if not is_online(item):
+                    continue
+                lead = Lead.from_json(item)
+                key = (str(lead.parent.phone), str(lead.payment.date))
+                if str(lead.id) in lead_ids or key in pairs:
+                    skipped += 1
+                    continue
+                lead_ids.add(str(lead.id))
+                leads.append(lead)
+            if leads:
+                await enrich(amo_client, leads)
+            if leads and not args.dry_run:
+                writes = [sheet_writer.write(lead.to_row()) for lead in leads]
+                if telegram:
+                    writes += [
+                        telegram.send_lead(group_chat_id, lead) for lead in leads
+                    ]
+                results = await asyncio.gather(*writes, return_exceptions=True)
+                # Ошибка в данных одной сделки (например, пустая сумма) не
+                # должна останавливать догрузку на этой странице
+                failed_ids = set()
+                for i, result in enumerate(results):
+                    if isinstance(result, Exception):
+                        lead = leads[i % len(leads)]
+                        failed_ids.add(lead.id)
+                        logger.error(f"Сделка #{lead.id} не записана: {result}")
+                failed += len(failed_ids)
+                leads = [lead for lead in leads if lead.id not in failed_ids]
+            written += len(leads)
+            if not args.dry_run:
+                checkpoint.save(page + 1)
+            logger.info(
+                f"Страница {page}: записано {len(leads)}, всего {written}, "
+                f"пропущено {skipped}, с ошибкой {failed}"
+            )
+    finally:
+        await sheet_writer.stop()
+        if telegram:
+            await telegram.stop()
+            await bot.session.close()
+        await amo_client.close_session()
+    logger.info(
+        f"Догрузка завершена: записано {written}, пропущено {skipped}, "
+        f"с ошибкой {failed}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--from", dest="date_from", help="Начало периода, YYYY-MM-DD")
+    parser.add_argument("--to", dest="date_to", help="Конец периода, YYYY-MM-DD")
+    parser.add_argument(
+        "--field",
+        default="closed_at",
+        choices=["closed_at", "created_at", "updated_at"],
+        help="Поле даты, по которому фильтруется период",
+    )
+    parser.add_argument("--pipeline-id", type=int)
+    parser.add_argument("--status-id", type=int)
+    parser.add_argument(
+        "--concurrency", type=int, default=2, help="Страниц загружать заранее"
+    )
+    parser.add_argument("--checkpoint", default="backfill_checkpoint.json")
+    parser.add_argument(
+        "--mirror", default="sheet_mirror.db", help="Локальная копия таблицы"
+    )
+    parser.add_argument(
+        "--telegram", action="store_true", help="Отправлять сделки и в Telegram"
+    )
+    parser.add_argument("--dry-run", action="store_true", help="Ничего не записывать")
+    args = parser.parse_args()
+    if args.status_id and not args.pipeline_id:
+        parser.error("--status-id требует --pipeline-id")
+    asyncio.run(backfill(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""Микробенчмарк разбора сделки `Lead.from_json`.
+
+Прогоняет записанные ответы AmoCRM (`payloads/leads.json`) через разбор и
+выводит среднее время на одну сделку. С `--max-us` завершается с ошибкой,
+если время превышает порог, — так регрессию видно до деплоя.
+
+    python -m benchmarks.bench_lead_parse --rounds 2000 --max-us 80
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from loguru import logger
+from amocrm.models import Lead, BranchIsNotOnline
+
+
+PAYLOADS = os.path.join(os.path.dirname(__file__), "payloads", "leads.json")
+
+
+def run(payloads: list, rounds: int) -> float:
+    """Возвращает среднее время разбора одной сделки в микросекундах"""
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for data in payloads:
+            try:
+                Lead.from_json(data)
+            except BranchIsNotOnline:
+                pass
+    elapsed = time.perf_counter() - started
+    return elapsed / (rounds * len(payloads)) * 1_000_000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--payloads", default=PAYLOADS)
+    parser.add_argument("--rounds", type=int, default=1000)
+    parser.add_argument("--max-us", type=float, default=None)
+    args = parser.parse_args()
+
+    logger.remove()  # Логи не должны влиять на замер
+    with open(args.payloads, encoding="utf-8") as f:
+        payloads = json.load(f)
+
+    run(payloads, max(1, args.rounds // 10))  # Прогрев
+    per_lead = run(payloads, args.rounds)
+    print(f"Lead.from_json: {per_lead:.1f} мкс/сделка ({len(payloads)} сделок)")
+    if args.max_us is not None and per_lead > args.max_us:
+        print(f"Превышен порог {args.max_us} мкс")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
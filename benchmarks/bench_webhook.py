@@ -0,0 +1,210 @@
+"""Нагрузочный тест вебхука на локальных заглушках AmoCRM, Telegram и Google Таблицы.
+
+Поднимает приложение из `main.py` (uvicorn в этом же процессе) против
+заглушек из `benchmarks/fakes.py`, отправляет записанные формы вебхуков
+(`payloads/webhooks.json`) с заданной частотой и выводит задержку ответа
+вебхука и полной обработки (до строки в таблице) — p50/p95/p99, пропускную
+способность и количество обращений к внешним сервисам.
+
+    python -m benchmarks.bench_webhook --rate 20 --duration 10
+    python -m benchmarks.bench_webhook --rate 50 --amo-429 0.05 --json result.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import statistics
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+import aiohttp
+import gspread
+import uvicorn
+from loguru import logger
+
+from benchmarks.fakes import FakeAmoCRM, FakeGspreadClient, FakeTelegram
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WEBHOOKS = os.path.join(os.path.dirname(__file__), "payloads", "webhooks.json")
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    """p50/p95/p99 в миллисекундах"""
+    if len(values) < 2:
+        value = values[0] * 1000 if values else 0.0
+        return {"p50": value, "p95": value, "p99": value}
+    cuts = statistics.quantiles(values, n=100)
+    return {
+        "p50": round(cuts[49] * 1000, 1),
+        "p95": round(cuts[94] * 1000, 1),
+        "p99": round(cuts[98] * 1000, 1),
+    }
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def render_form(template: dict, lead_ids: List[int]) -> dict:
+    ids = {"{id}": str(lead_ids[0]), "{id2}": str(lead_ids[1])}
+    return {key: ids.get(value, value) for key, value in template.items()}
+
+
+async def wait_idle(main, timeout: float):
+    """Ждет, пока все принятые сделки будут обработаны"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        stats = main.pipeline.stats()
+        if (
+            stats["queue_size"] == 0
+            and stats["busy_workers"] == 0
+            and stats["deferred"] == 0
+            and main.sheet_writer.queue_size == 0
+            and main.telegram.stats()["queue_size"] == 0
+        ):
+            return True
+        await asyncio.sleep(0.1)
+    return False
+
+
+async def run(args) -> dict:
+    amo = await FakeAmoCRM(
+        latency=args.amo_latency, error_rate=args.amo_429, online_ratio=args.online
+    ).start()
+    telegram = await FakeTelegram(latency=args.telegram_latency).start()
+    sheets = FakeGspreadClient(worksheet_latency=args.sheets_latency)
+
+    workdir = tempfile.mkdtemp(prefix="bench_")
+    os.chdir(workdir)  # Логи и файлы очередей приложения — во временной папке
+    os.environ.update(
+        {
+            "amocrm_url": amo.url,
+            "telegram_api_url": telegram.url,
+            "telegram_token": "123456:BENCHMARK",
+            "group": "-100",
+            "access_token": "benchmark",
+            "job_store_path": os.path.join(workdir, "jobs.db"),
+            # Заглушка Telegram не ограничивает частоту
+            "telegram_rate_per_minute": str(args.telegram_rate),
+        }
+    )
+    gspread.service_account = lambda *a, **kw: sheets
+    sys.path.insert(0, ROOT)
+    import main
+
+    if not args.verbose:
+        logger.remove()
+        logger.add(sys.stderr, level="WARNING")
+
+    port = free_port()
+    server = uvicorn.Server(
+        uvicorn.Config(main.app, host="127.0.0.1", port=port, log_level="warning")
+    )
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+
+    with open(WEBHOOKS, encoding="utf-8") as f:
+        templates = json.load(f)
+
+    sent_at: Dict[int, float] = {}
+    ack: List[float] = []
+    errors = 0
+    next_id = 40_000_000
+
+    async def send(session: aiohttp.ClientSession, form: dict, ids: List[int]):
+        nonlocal errors
+        started = time.monotonic()
+        for lead_id in ids:
+            sent_at[lead_id] = started
+        try:
+            async with session.post(
+                f"http://127.0.0.1:{port}/webhook", data=form
+            ) as response:
+                await response.read()
+                if response.status != 200:
+                    errors += 1
+        except aiohttp.ClientError:
+            errors += 1
+        ack.append(time.monotonic() - started)
+
+    total = int(args.rate * args.duration)
+    started = time.monotonic()
+    async with aiohttp.ClientSession() as session:
+        tasks = []
+        for i in range(total):
+            # Открытая модель нагрузки: запросы уходят по расписанию, не дожидаясь ответов
+            await asyncio.sleep(max(0.0, started + i / args.rate - time.monotonic()))
+            template = templates[i % len(templates)]
+            ids = [next_id, next_id + 1]
+            next_id += 2
+            used = ids if "{id2}" in template.values() else ids[:1]
+            tasks.append(
+                asyncio.create_task(send(session, render_form(template, ids), used))
+            )
+        await asyncio.gather(*tasks)
+    send_window = time.monotonic() - started
+    drained = await wait_idle(main, args.drain_timeout)
+
+    worksheet = sheets.spreadsheet.worksheet("Лист1")
+    end_to_end = []
+    for row, inserted_at in zip(worksheet.rows, worksheet.inserted_at):
+        lead_id = int(row[-1])
+        if lead_id in sent_at:
+            end_to_end.append(inserted_at - sent_at[lead_id])
+    finished = max(worksheet.inserted_at, default=time.monotonic())
+
+    server.should_exit = True
+    await server_task
+    await amo.stop()
+    await telegram.stop()
+
+    return {
+        "requests": total,
+        "leads": len(sent_at),
+        "errors": errors,
+        "drained": drained,
+        "ack_ms": percentiles(ack),
+        "end_to_end_ms": percentiles(end_to_end),
+        "webhooks_per_s": round(total / send_window, 1),
+        "rows_written": len(end_to_end),
+        "rows_per_s": round(len(end_to_end) / max(finished - started, 1e-9), 1),
+        "amocrm_calls": dict(amo.calls),
+        "telegram_calls": dict(telegram.calls),
+        "telegram_messages": len(telegram.messages),
+        "sheets_calls": dict(worksheet.calls),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rate", type=float, default=20, help="Вебхуков в секунду")
+    parser.add_argument("--duration", type=float, default=10, help="Секунд нагрузки")
+    parser.add_argument("--online", type=float, default=0.3, help="Доля онлайн-сделок")
+    parser.add_argument("--amo-latency", type=float, default=0.05)
+    parser.add_argument("--amo-429", type=float, default=0.0, help="Доля ответов 429")
+    parser.add_argument("--telegram-latency", type=float, default=0.05)
+    parser.add_argument("--telegram-rate", type=float, default=6000)
+    parser.add_argument("--sheets-latency", type=float, default=0.2)
+    parser.add_argument("--drain-timeout", type=float, default=60)
+    parser.add_argument("--json", help="Сохранить результат в файл")
+    parser.add_argument("--verbose", action="store_true", help="Не отключать логи")
+    args = parser.parse_args()
+    if args.json:
+        args.json = os.path.abspath(args.json)
+
+    result = asyncio.run(run(args))
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
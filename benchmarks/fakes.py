@@ -0,0 +1,354 @@
+"""Локальные заменители AmoCRM, Telegram Bot API и Google Таблицы.
+
+Используются нагрузочным тестом: сервера поднимаются на случайных портах,
+отвечают с настраиваемой задержкой (и, для AmoCRM, долей ответов 429) и
+считают обращения, чтобы можно было сравнить количество запросов к внешним
+сервисам между версиями.
+"""
+
+import asyncio
+import json
+import os
+import random
+import time
+from abc import ABC, abstractmethod
+from collections import Counter
+from typing import Dict, List, Optional
+from aiohttp import web
+
+PAYLOADS = os.path.join(os.path.dirname(__file__), "payloads", "leads.json")
+
+
+def load_leads(path: str = PAYLOADS) -> List[dict]:
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+class FakeServer(ABC):
+    """Общая часть заглушек: запуск на свободном порту и счетчик вызовов"""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls: Counter = Counter()
+        self._runner: Optional[web.AppRunner] = None
+        self.url = ""
+
+    @abstractmethod
+    def routes(self) -> List[web.RouteDef]:
+        """Маршруты заглушки"""
+
+    async def start(self):
+        app = web.Application()
+        app.add_routes(self.routes())
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}"
+        return self
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+    async def _delay(self):
+        if self.latency:
+            await asyncio.sleep(random.uniform(self.latency / 2, self.latency * 1.5))
+
+
+class FakeAmoCRM(FakeServer):
+    """Заглушка AmoCRM API v4.
+
+    Сделка с любым `id` строится из записанного ответа (`id % len(leads)`),
+    доля `online_ratio` сделок получает филиал «Онлайн». С вероятностью
+    `error_rate` отвечает 429 с `Retry-After`.
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.05,
+        error_rate: float = 0.0,
+        online_ratio: float = 0.3,
+        users: int = 12,
+    ):
+        super().__init__(latency)
+        self.error_rate = error_rate
+        self.online_ratio = online_ratio
+        self.templates = load_leads()
+        self.user_ids = sorted(
+            {lead["responsible_user_id"] for lead in self.templates}
+        )[:users]
+        self.events: List[dict] = []
+
+    def routes(self):
+        return [
+            web.get("/api/v4/account", self.account),
+            web.get("/api/v4/leads", self.leads),
+            web.get("/api/v4/leads/{id}", self.lead),
+            web.get("/api/v4/users", self.users),
+            web.get("/api/v4/users/{id}", self.user),
+            web.get("/api/v4/contacts", self.contacts),
+            web.get("/api/v4/contacts/{id}", self.contact),
+            web.get("/api/v4/events", self.events_page),
+        ]
+
+    def add_event(self, lead_id: int, status_id: int = 142, pipeline_id: int = 1):
+        """Событие смены статуса сделки для опроса `/api/v4/events`"""
+        self.events.append(
+            {
+                "id": f"{len(self.events):024x}",
+                "type": "lead_status_changed",
+                "entity_id": lead_id,
+                "entity_type": "lead",
+                "created_at": int(time.time()),
+                "value_after": [
+                    {"lead_status": {"id": status_id, "pipeline_id": pipeline_id}}
+                ],
+            }
+        )
+
+    def make_lead(self, lead_id: int) -> dict:
+        lead = dict(self.templates[lead_id % len(self.templates)])
+        lead["id"] = lead_id
+        online = (lead_id * 2654435761 % 1000) < self.online_ratio * 1000
+        lead["custom_fields_values"] = [
+            (
+                {**field, "values": [{"value": "Онлайн" if online else "Алматы"}]}
+                if field.get("field_name") == "Филиал"
+                else field
+            )
+            for field in lead["custom_fields_values"]
+        ]
+        lead["_embedded"] = {"contacts": [{"id": lead_id + 1_000_000_000}]}
+        return lead
+
+    def make_contact(self, contact_id: int) -> dict:
+        return {
+            "id": contact_id,
+            "name": "Родитель",
+            "custom_fields_values": [
+                {
+                    "field_name": "Email",
+                    "values": [{"value": f"parent{contact_id}@example.com"}],
+                }
+            ],
+        }
+
+    def make_user(self, user_id: int) -> dict:
+        return {"id": user_id, "name": f"Менеджер {user_id}"}
+
+    async def _respond(self, request: web.Request, name: str, body: Optional[dict]):
+        self.calls[name] += 1
+        await self._delay()
+        if self.error_rate and random.random() < self.error_rate:
+            self.calls["429"] += 1
+            return web.json_response(
+                {"title": "Too Many Requests"}, status=429, headers={"Retry-After": "1"}
+            )
+        if body is None:
+            return web.Response(status=204)
+        return web.json_response(body)
+
+    async def account(self, request):
+        return await self._respond(request, "account", {"id": 1, "subdomain": "fake"})
+
+    async def lead(self, request):
+        lead_id = int(request.match_info["id"])
+        return await self._respond(request, "lead", self.make_lead(lead_id))
+
+    async def leads(self, request):
+        ids = [int(id) for id in request.query.getall("filter[id][]", [])]
+        body = {"_embedded": {"leads": [self.make_lead(id) for id in ids]}}
+        return await self._respond(request, "leads", body if ids else None)
+
+    async def events_page(self, request):
+        query = request.query
+        since = int(query.get("filter[created_at][from]", 0))
+        until = int(query.get("filter[created_at][to]", 2**31))
+        limit = int(query.get("limit", 100))
+        page = int(query.get("page", 1))
+        matched = [e for e in self.events if since <= e["created_at"] <= until]
+        # Как и AmoCRM, отдаем сначала новые события
+        matched.reverse()
+        chunk = matched[(page - 1) * limit : page * limit]
+        body = {"_embedded": {"events": chunk}, "_links": {}}
+        if page * limit < len(matched):
+            body["_links"]["next"] = {"href": f"?page={page + 1}"}
+        return await self._respond(request, "events", body if chunk else None)
+
+    async def user(self, request):
+        user_id = int(request.match_info["id"])
+        return await self._respond(request, "user", self.make_user(user_id))
+
+    async def users(self, request):
+        body = {"_embedded": {"users": [self.make_user(id) for id in self.user_ids]}}
+        return await self._respond(request, "users", body)
+
+    async def contact(self, request):
+        contact_id = int(request.match_info["id"])
+        return await self._respond(request, "contact", self.make_contact(contact_id))
+
+    async def contacts(self, request):
+        ids = [int(id) for id in request.query.getall("filter[id][]", [])]
+        body = {"_embedded": {"contacts": [self.make_contact(id) for id in ids]}}
+        return await self._respond(request, "contacts", body if ids else None)
+
+
+class FakeTelegram(FakeServer):
+    """Заглушка Telegram Bot API: `getMe` и `sendMessage`"""
+
+    def __init__(self, latency: float = 0.05):
+        super().__init__(latency)
+        self.messages: List[tuple] = []
+
+    def routes(self):
+        return [web.post("/bot{token}/{method}", self.method)]
+
+    async def method(self, request: web.Request):
+        method = request.match_info["method"]
+        self.calls[method] += 1
+        await self._delay()
+        if method.lower() == "getme":
+            result = {
+                "id": 1,
+                "is_bot": True,
+                "first_name": "Fake",
+                "username": "fake_bot",
+            }
+        else:
+            data = await request.post()
+            self.messages.append((time.monotonic(), data.get("text", "")))
+            result = {
+                "message_id": len(self.messages),
+                "date": int(time.time()),
+                "chat": {"id": int(data.get("chat_id", 0)), "type": "group"},
+                "text": data.get("text", ""),
+            }
+        return web.json_response({"ok": True, "result": result})
+
+
+class InMemoryWorksheet:
+    """Часть интерфейса `gspread.Worksheet`, которой пользуется приложение.
+
+    Вызовы выполняются с задержкой `latency` (как блокирующий HTTP-запрос
+    gspread), время вставки каждой строки запоминается.
+    """
+
+    def __init__(self, title: str = "Лист1", latency: float = 0.2, rows: int = 1000):
+        self.title = title
+        self.latency = latency
+        self.row_count = rows
+        self.rows: List[list] = []
+        self.inserted_at: List[float] = []
+        self.calls: Counter = Counter()
+
+    def _delay(self, name: str):
+        self.calls[name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def get_all_values(self):
+        self._delay("get_all_values")
+        return [list(map(str, row)) for row in self.rows]
+
+    def insert_row(self, values, index: int = 1, **kwargs):
+        self.insert_rows([values], index, **kwargs)
+
+    def insert_rows(self, values, row: int = 1, **kwargs):
+        self._delay("insert_rows")
+        row = min(row - 1, len(self.rows))
+        self.rows[row:row] = [list(v) for v in values]
+        now = time.monotonic()
+        self.inserted_at[row:row] = [now] * len(values)
+        self.row_count += len(values)
+
+    def batch_get(self, ranges, **kwargs):
+        self._delay("batch_get")
+        return [self._column(r) for r in ranges]
+
+    def get(self, range_name=None, **kwargs):
+        self._delay("get")
+        return [list(map(str, row)) for row in self.rows]
+
+    def _column(self, a1: str):
+        from gspread.utils import a1_to_rowcol
+
+        start = a1.split(":")[0]
+        if not start[-1].isdigit():
+            start += "1"
+        first, column = a1_to_rowcol(start)
+        values = [
+            [str(row[column - 1])] if len(row) >= column else []
+            for row in self.rows[first - 1 :]
+        ]
+        # Как и Sheets API, пустые ячейки в конце диапазона не возвращаются
+        while values and not values[-1]:
+            values.pop()
+        return values
+
+
+class FakeSpreadsheet:
+    def __init__(self, worksheet_latency: float = 0.2):
+        self.latency = worksheet_latency
+        self.sheets: Dict[str, InMemoryWorksheet] = {}
+
+    def worksheet(self, title: str) -> InMemoryWorksheet:
+        if title not in self.sheets:
+            self.sheets[title] = InMemoryWorksheet(title, self.latency)
+        return self.sheets[title]
+
+    def worksheets(self) -> List[InMemoryWorksheet]:
+        return list(self.sheets.values())
+
+    def add_worksheet(self, title: str, rows: int = 1000, cols: int = 26, **kwargs):
+        # Как и Google Таблицы, не создает второй лист с тем же названием
+        if title in self.sheets:
+            raise ValueError(f'A sheet with the name "{title}" already exists')
+        return self.worksheet(title)
+
+
+class FakeGspreadClient:
+    """Замена `gspread.service_account()`: одна таблица в памяти"""
+
+    def __init__(self, worksheet_latency: float = 0.2):
+        self.spreadsheet = FakeSpreadsheet(worksheet_latency)
+
+    def open_by_key(self, key: str) -> FakeSpreadsheet:
+        return self.spreadsheet
+
+
+class InMemoryRedis:
+    """Заменитель клиента `redis.asyncio.Redis` для `RedisCoordinator`.
+
+    Поддерживает только `get`, `set` (с `nx` и `px`) и `delete`; один
+    экземпляр, переданный нескольким координаторам, изображает общий сервер.
+    """
+
+    def __init__(self):
+        self.data: Dict[str, tuple] = {}
+        self.calls: Counter = Counter()
+
+    def _alive(self, key: str):
+        item = self.data.get(key)
+        if item and item[1] is not None and item[1] < time.monotonic():
+            del self.data[key]
+            return None
+        return item
+
+    async def get(self, key: str):
+        self.calls["get"] += 1
+        item = self._alive(key)
+        return item[0].encode() if item else None
+
+    async def set(self, key: str, value, nx: bool = False, px: Optional[int] = None):
+        self.calls["set"] += 1
+        if nx and self._alive(key):
+            return None
+        expires_at = time.monotonic() + px / 1000 if px else None
+        self.data[key] = (str(value), expires_at)
+        return True
+
+    async def delete(self, key: str):
+        self.calls["delete"] += 1
+        return 1 if self.data.pop(key, None) else 0
@@ -0,0 +1,306 @@
+"""Общее состояние нескольких процессов приложения.
+
+При запуске нескольких воркеров uvicorn (или нескольких копий на разных
+машинах) каждый процесс держит свои очереди и кэши, но часть решений должна
+приниматься один раз на всех:
+
+- номер следующей свободной строки таблицы (`SheetWriter`);
+- отбрасывание повторных уведомлений (`/webhook`);
+- лимит частоты запросов к AmoCRM (`SharedTokenBucket`);
+- обновление OAuth-токена AmoCRM (новый refresh_token выдается один раз).
+
+Бэкенд предоставляет несколько операций над ключами со сроком жизни (`get`,
+`set`, `delete`, `claim` — записать, если ключа нет, `release` — удалить, если
+значение совпадает), из которых `Coordinator` строит блокировки и ведро
+токенов. Есть два бэкенда:
+
+- `SQLiteCoordinator` — файл базы на общем диске, для воркеров одной машины;
+- `RedisCoordinator` — любой клиент с интерфейсом `redis.asyncio.Redis`
+  (`get`, `set(nx=, px=)`, `delete`), для нескольких машин.
+"""
+
+import asyncio
+import sqlite3
+import time
+import uuid
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import Optional, Set
+from loguru import logger
+
+
+class Coordinator(ABC):
+    """Общие для процессов блокировки и значения поверх хранилища ключей"""
+
+    lock_poll_interval = 0.05
+
+    @abstractmethod
+    async def get(self, key: str) -> Optional[str]:
+        """Значение ключа или None, если ключа нет или его срок истек"""
+
+    @abstractmethod
+    async def set(self, key: str, value: str, ttl: Optional[float] = None):
+        """Записывает значение; `ttl` — срок жизни в секундах"""
+
+    @abstractmethod
+    async def delete(self, key: str):
+        """Удаляет ключ"""
+
+    @abstractmethod
+    async def claim(self, key: str, ttl: float, value: str = "1") -> bool:
+        """Записывает ключ, если его нет (или срок истек); True — ключ наш"""
+
+    @abstractmethod
+    async def release(self, key: str, value: str):
+        """Удаляет ключ, если он все еще хранит `value`"""
+
+    def close(self):
+        pass
+
+    @asynccontextmanager
+    async def lock(self, name: str, ttl: float = 30.0, timeout: float = 60.0):
+        """Блокировка на все процессы.
+
+        `ttl` ограничивает время удержания: если процесс упал, не сняв
+        блокировку, она освободится сама.
+        """
+        key = f"lock:{name}"
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + timeout
+        while not await self.claim(key, ttl, token):
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Не удалось получить блокировку {name}")
+            await asyncio.sleep(self.lock_poll_interval)
+        try:
+            yield
+        finally:
+            await self.release(key, token)
+
+    def bucket(self, name: str, rate: float, capacity: Optional[float] = None):
+        return SharedTokenBucket(self, name, rate, capacity)
+
+
+class SQLiteCoordinator(Coordinator):
+    """Координация через файл SQLite, общий для процессов одной машины.
+
+    Запросы ждут блокировку файла, пока ее держит другой процесс, поэтому
+    выполняются в отдельном потоке, а не в цикле событий.
+    """
+
+    def __init__(self, path: str = "coordination.db", busy_timeout: float = 5.0):
+        self.path = path
+        # Один поток: соединение SQLite используется строго по очереди
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="coordination"
+        )
+        self._conn = sqlite3.connect(
+            path, isolation_level=None, timeout=busy_timeout, check_same_thread=False
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS coordination (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                expires_at REAL
+            )
+            """
+        )
+        self._conn.execute(
+            "DELETE FROM coordination WHERE expires_at < ?", (time.time(),)
+        )
+        logger.info(f"Общее состояние воркеров: {path}")
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    async def get(self, key: str) -> Optional[str]:
+        return await self._run(self._get, key)
+
+    def _get(self, key: str) -> Optional[str]:
+        row = self._conn.execute(
+            "SELECT value FROM coordination WHERE key = ? AND (expires_at IS NULL OR expires_at >= ?)",
+            (key, time.time()),
+        ).fetchone()
+        return row[0] if row else None
+
+    async def set(self, key: str, value: str, ttl: Optional[float] = None):
+        await self._run(
+            self._conn.execute,
+            "INSERT OR REPLACE INTO coordination (key, value, expires_at) VALUES (?, ?, ?)",
+            (key, value, time.time() + ttl if ttl is not None else None),
+        )
+
+    async def delete(self, key: str):
+        await self._run(
+            self._conn.execute, "DELETE FROM coordination WHERE key = ?", (key,)
+        )
+
+    async def claim(self, key: str, ttl: float, value: str = "1") -> bool:
+        return await self._run(self._claim, key, ttl, value)
+
+    def _claim(self, key: str, ttl: float, value: str) -> bool:
+        now = time.time()
+        # IMMEDIATE сразу берет блокировку записи: проверка и вставка атомарны
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._conn.execute(
+                "DELETE FROM coordination WHERE key = ? AND expires_at < ?", (key, now)
+            )
+            cursor = self._conn.execute(
+                "INSERT OR IGNORE INTO coordination (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, value, now + ttl),
+            )
+            self._conn.execute("COMMIT")
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+        return cursor.rowcount == 1
+
+    async def release(self, key: str, value: str):
+        await self._run(
+            self._conn.execute,
+            "DELETE FROM coordination WHERE key = ? AND value = ?",
+            (key, value),
+        )
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self._conn.close()
+
+
+class RedisCoordinator(Coordinator):
+    """Координация через Redis (или совместимый сервер) для нескольких машин"""
+
+    def __init__(self, client, prefix: str = "leads:"):
+        self.client = client
+        self.prefix = prefix
+
+    @staticmethod
+    def _ms(ttl: Optional[float]) -> Optional[int]:
+        return max(1, int(ttl * 1000)) if ttl is not None else None
+
+    async def get(self, key: str) -> Optional[str]:
+        value = await self.client.get(self.prefix + key)
+        return value.decode() if isinstance(value, bytes) else value
+
+    async def set(self, key: str, value: str, ttl: Optional[float] = None):
+        await self.client.set(self.prefix + key, value, px=self._ms(ttl))
+
+    async def delete(self, key: str):
+        await self.client.delete(self.prefix + key)
+
+    async def claim(self, key: str, ttl: float, value: str = "1") -> bool:
+        return bool(
+            await self.client.set(self.prefix + key, value, nx=True, px=self._ms(ttl))
+        )
+
+    async def release(self, key: str, value: str):
+        # Без скрипта Lua проверка и удаление не атомарны, но ключ блокировки
+        # со случайным значением может совпасть только у его владельца
+        if await self.get(key) == value:
+            await self.delete(key)
+
+
+class SharedTokenBucket:
+    """Ведро токенов, общее для всех процессов (интерфейс как у `TokenBucket`).
+
+    Хранится одно число — время, к которому будет выдан следующий токен
+    (алгоритм GCRA). Каждый `acquire` под общей блокировкой сдвигает его на
+    `1 / rate`, а ждет уже вне блокировки.
+    """
+
+    def __init__(
+        self,
+        coordinator: Coordinator,
+        name: str,
+        rate: float,
+        capacity: Optional[float] = None,
+    ):
+        self.coordinator = coordinator
+        self.name = name
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self._key = f"bucket:{name}"
+        self._paused_until = 0.0
+        self._pause_tasks: Set[asyncio.Task] = set()
+        self.acquired = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    async def acquire(self) -> float:
+        """Ждет токен и возвращает время ожидания в секундах"""
+        started = time.monotonic()
+        async with self.coordinator.lock(self._key, ttl=5):
+            now = time.time()
+            value = await self.coordinator.get(self._key)
+            tat = max(float(value) if value else now, now, self._paused_until)
+            delay = max(0.0, tat - now - (self.capacity - 1) / self.rate)
+            await self.coordinator.set(self._key, repr(tat + 1 / self.rate), ttl=3600)
+        if delay:
+            await asyncio.sleep(delay)
+        waited = time.monotonic() - started
+        self.acquired += 1
+        self.total_wait += waited
+        if waited > self.max_wait:
+            self.max_wait = waited
+        return waited
+
+    def pause(self, delay: float):
+        """Не выдавать токены ближайшие `delay` секунд (например, после 429).
+
+        Пауза сразу действует в этом процессе, а в остальных — со следующего
+        токена, после записи в общее состояние.
+        """
+        # Как и у `TokenBucket`, пауза опустошает ведро: запас всплеска
+        # (`capacity - 1` токенов) не должен ее сокращать
+        tat = time.time() + delay + (self.capacity - 1) / self.rate
+        self._paused_until = max(self._paused_until, tat)
+        # Ссылка на задачу нужна, чтобы ее не собрал сборщик мусора
+        task = asyncio.create_task(self._share_pause())
+        self._pause_tasks.add(task)
+        task.add_done_callback(self._pause_done)
+
+    def _pause_done(self, task: asyncio.Task):
+        self._pause_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning(
+                f"Не удалось передать паузу {self.name} воркерам: {task.exception()}"
+            )
+
+    async def _share_pause(self):
+        async with self.coordinator.lock(self._key, ttl=5):
+            value = await self.coordinator.get(self._key)
+            tat = max(float(value) if value else 0.0, self._paused_until)
+            await self.coordinator.set(self._key, repr(tat), ttl=3600)
+
+    def stats(self) -> dict:
+        return {
+            "acquired": self.acquired,
+            "avg_wait_ms": (
+                round(self.total_wait / self.acquired * 1000, 2) if self.acquired else 0.0
+            ),
+            "max_wait_ms": round(self.max_wait * 1000, 2),
+            "total_wait_s": round(self.total_wait, 3),
+        }
+
+
+def create_coordinator(
+    backend: str, path: str = "coordination.db", redis_url: Optional[str] = None
+) -> Optional[Coordinator]:
+    """Бэкенд по имени: "" (один процесс), "sqlite" или "redis" """
+    if not backend:
+        return None
+    if backend == "sqlite":
+        return SQLiteCoordinator(path)
+    if backend == "redis":
+        try:
+            from redis import asyncio as redis
+        except ImportError as e:
+            raise RuntimeError("Для coordination=redis установите пакет redis") from e
+        return RedisCoordinator(redis.from_url(redis_url or "redis://localhost:6379"))
+    raise ValueError(f"Неизвестный бэкенд координации: {backend}")
+
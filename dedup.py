@@ -0,0 +1,91 @@
+import sqlite3
+import time
+from collections import OrderedDict
+from typing import Optional
+from loguru import logger
+
+
+class DedupIndex:
+    """Индекс уже принятых уведомлений для отбрасывания повторов.
+
+    Ключ хранится `ttl` секунд. Записи лежат в порядке добавления, а срок
+    жизни у всех одинаковый, поэтому устаревшие вытесняются с начала без
+    полного перебора. Если задан `path`, индекс дублируется в SQLite и
+    переживает перезапуск. Если задан `coordinator`, `check` дополнительно
+    сверяется с общим индексом воркеров.
+    """
+
+    def __init__(
+        self, ttl: float = 3600, path: Optional[str] = None, coordinator=None
+    ):
+        self.ttl = ttl
+        self.coordinator = coordinator
+        self._entries: "OrderedDict[str, float]" = OrderedDict()
+        self._conn: Optional[sqlite3.Connection] = None
+        self.hits = 0
+        self.misses = 0
+        if path:
+            self._conn = sqlite3.connect(path, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS dedup (key TEXT PRIMARY KEY, expires_at REAL NOT NULL)"
+            )
+            now = time.time()
+            self._conn.execute("DELETE FROM dedup WHERE expires_at < ?", (now,))
+            for key, expires_at in self._conn.execute(
+                "SELECT key, expires_at FROM dedup ORDER BY expires_at"
+            ):
+                # В памяти храним монотонное время, на диске — настенное
+                self._entries[key] = time.monotonic() + (expires_at - now)
+            logger.info(f"Индекс повторов загружен: {len(self._entries)} ключей")
+
+    def _evict(self, now: float):
+        while self._entries:
+            key, expires_at = next(iter(self._entries.items()))
+            if expires_at > now:
+                break
+            del self._entries[key]
+
+    def seen(self, key: str) -> bool:
+        """Проверяет, был ли ключ уже принят, и запоминает его"""
+        now = time.monotonic()
+        self._evict(now)
+        if key in self._entries:
+            self.hits += 1
+            return True
+        self.misses += 1
+        self._entries[key] = now + self.ttl
+        if self._conn is not None:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO dedup (key, expires_at) VALUES (?, ?)",
+                (key, time.time() + self.ttl),
+            )
+        return False
+
+    async def check(self, key: str) -> bool:
+        """Как `seen`, но ключ, принятый другим воркером, тоже считается повтором"""
+        if self.seen(key):
+            return True
+        if self.coordinator is None:
+            return False
+        if await self.coordinator.claim(f"dedup:{key}", self.ttl):
+            return False
+        self.misses -= 1
+        self.hits += 1
+        return True
+
+    async def forget(self, key: str):
+        """Удаляет ключ, чтобы повторное уведомление снова было принято"""
+        self._entries.pop(key, None)
+        if self._conn is not None:
+            self._conn.execute("DELETE FROM dedup WHERE key = ?", (key,))
+        if self.coordinator is not None:
+            await self.coordinator.delete(f"dedup:{key}")
+
+    def stats(self) -> dict:
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
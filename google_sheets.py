@@ -1,31 +1,252 @@
 import gspread
 import os
+import re
+import threading
+import time
+from typing import Dict, List, Optional
+from gspread.utils import rowcol_to_a1
 from loguru import logger
+from amocrm.models import SHEET_COLUMNS
+from sheet_mirror import (
+    FIRST_COLUMN,
+    MIRROR_COLUMNS,
+    PAYMENT_DATE_COLUMN,
+    SheetMirror,
+    row_keys,
+)
+
+SPREADSHEET_KEY = "1KWsRADiDlfxA5Z_DD6Play_2AnAwpYZ-8ceEpdzOv7U"
+DEFAULT_WORKSHEET = "Лист1"
+# Заголовок, с которым создаются новые листы
+HEADER = [name for name, _ in SHEET_COLUMNS]
+# Названия листов разбиения: месяц или основной лист, с номером продолжения
+SHARD_TITLE = re.compile(
+    rf"^(\d{{4}}-\d{{2}}|{re.escape(DEFAULT_WORKSHEET)})( \(\d+\))?$"
+)
 
 
 class GoogleSheets:
+    """Лист Google Таблицы с заявками.
 
-    def __init__(self):
-        try:
-            logger.info("Инициализация GoogleSheets")
-            gc = gspread.service_account(filename="credentials.json")
-            sh = gc.open_by_key("1KWsRADiDlfxA5Z_DD6Play_2AnAwpYZ-8ceEpdzOv7U")
-            self.worksheet = sh.worksheet("Лист1")
-            logger.info("Успешное подключение к таблице")
-        except Exception as e:
-            logger.error(f"Ошибка при инициализации GoogleSheets: {e}")
-            raise
+    Подключение (авторизация сервисного аккаунта и открытие таблицы) — это
+    блокирующие сетевые вызовы, поэтому конструктор их не делает: они
+    выполняются в `connect()` или при первом обращении к `worksheet`.
+
+    Если передана `mirror`, ключи строк листа хранятся в локальной копии:
+    количество заполненных строк и поиск сделок не требуют скачивания листа.
+
+    Строки можно раскладывать по нескольким листам (`route`): при
+    `shard_by="month"` — по месяцу даты оплаты (лист `2024-10`), при
+    `max_rows` — в следующий лист (`Лист1 (2)`), когда текущий заполнен.
+    Недостающий лист создается с заголовком, открытые листы кэшируются.
+    """
+
+    def __init__(
+        self,
+        mirror: Optional[SheetMirror] = None,
+        shard_by: str = "",
+        max_rows: int = 0,
+    ):
+        self._worksheet = None
+        self._lock = threading.Lock()
+        self.mirror = mirror
+        if shard_by not in ("", "month"):
+            raise ValueError(f"Неизвестный способ разбиения листов: {shard_by}")
+        self.shard_by = shard_by
+        self.max_rows = max_rows
+        self._spreadsheet = None
+        self._shards: Optional[Dict[str, gspread.Worksheet]] = None
+        self._synced = set()  # Листы, копия которых уже сверена в этом процессе
+        self._suffix: Dict[str, int] = {}  # Номер текущего листа для основы имени
+
+    def connect(self):
+        """Подключается к таблице, если это еще не сделано, и возвращает лист."""
+        with self._lock:
+            if self._worksheet is not None:
+                return self._worksheet
+            try:
+                logger.info("Инициализация GoogleSheets")
+                gc = gspread.service_account(filename="credentials.json")
+                sh = gc.open_by_key(SPREADSHEET_KEY)
+                self._worksheet = sh.worksheet(DEFAULT_WORKSHEET)
+                self._spreadsheet = sh
+                logger.info("Успешное подключение к таблице")
+            except Exception as e:
+                logger.error(f"Ошибка при инициализации GoogleSheets: {e}")
+                raise
+            return self._worksheet
+
+    @property
+    def connected(self) -> bool:
+        return self._worksheet is not None
+
+    @property
+    def worksheet(self):
+        return self._worksheet or self.connect()
+
+    def shard(self, title: str):
+        """Лист по названию; если его нет, он создается с заголовком."""
+        if title == DEFAULT_WORKSHEET:
+            return self.worksheet
+        self._load_shards()
+        if title not in self._shards:
+            # Лист мог создать другой процесс (воркер или backfill.py)
+            self._load_shards(reload=True)
+        with self._lock:
+            worksheet = self._shards.get(title)
+            if worksheet is None:
+                try:
+                    logger.info(f"Создание листа {title}")
+                    worksheet = self._spreadsheet.add_worksheet(
+                        title, rows=1000, cols=len(HEADER)
+                    )
+                except Exception as e:
+                    # Другой процесс успел создать лист раньше нас
+                    self._shards = {
+                        ws.title: ws for ws in self._spreadsheet.worksheets()
+                    }
+                    if title not in self._shards:
+                        logger.error(f"Ошибка при создании листа {title}: {e}")
+                        raise
+                    logger.info(f"Лист {title} уже создан другим процессом")
+                    return self._shards[title]
+                try:
+                    worksheet.insert_row(HEADER, 1)
+                except Exception as e:
+                    logger.error(f"Ошибка при создании листа {title}: {e}")
+                    raise
+                self._shards[title] = worksheet
+                if self.mirror is not None:
+                    self.mirror.reset(title)
+                    self.mirror.append(title, 1, [row_keys(HEADER)])
+                    self._synced.add(title)
+            return worksheet
+
+    def _load_shards(self, reload: bool = False):
+        """Получает список листов таблицы: один раз или заново с `reload`"""
+        self.connect()
+        with self._lock:
+            if self._shards is None or reload:
+                self._shards = {ws.title: ws for ws in self._spreadsheet.worksheets()}
+
+    def _sheet(self, sheet: Optional[str]):
+        return self.shard(sheet) if sheet else self.worksheet
+
+    def _shard_base(self, row) -> str:
+        if self.shard_by != "month":
+            return DEFAULT_WORKSHEET
+        # Дата оплаты в формате YYYY-MM-DD; без нее — месяц записи
+        payment_date = str(row[PAYMENT_DATE_COLUMN - 1])
+        return payment_date[:7] if payment_date else time.strftime("%Y-%m")
+
+    @staticmethod
+    def _shard_title(base: str, number: int) -> str:
+        return base if number == 1 else f"{base} ({number})"
+
+    def _existing_suffix(self, base: str) -> int:
+        """Номер последнего существующего листа с основой имени `base`"""
+        self._load_shards()
+        number = 1
+        while self._shard_title(base, number + 1) in self._shards:
+            number += 1
+        return number
+
+    def sheet_titles(self) -> List[str]:
+        """Листы, в которые пишет приложение: основной и листы разбиения"""
+        if not self.shard_by and not self.max_rows:
+            return [DEFAULT_WORKSHEET]
+        self._load_shards()
+        return [title for title in self._shards if SHARD_TITLE.match(title)]
+
+    def route(self, rows) -> Dict[str, List[int]]:
+        """Раскладывает строки по листам: название листа -> номера строк в `rows`"""
+        if not self.shard_by and not self.max_rows:
+            return {DEFAULT_WORKSHEET: list(range(len(rows)))}
+        groups: Dict[str, List[int]] = {}
+        filled: Dict[str, int] = {}
+        for i, row in enumerate(rows):
+            base = self._shard_base(row)
+            if self.max_rows:
+                if base not in self._suffix:
+                    self._suffix[base] = self._existing_suffix(base)
+                title = self._shard_title(base, self._suffix[base])
+                if title not in filled:
+                    filled[title] = self._filled_rows(title)
+                if filled[title] >= self.max_rows:
+                    # Лист заполнен — начинаем следующий
+                    self._suffix[base] += 1
+                    title = self._shard_title(base, self._suffix[base])
+                    filled[title] = 1  # Заголовок нового листа
+                filled[title] += 1
+            else:
+                title = base
+            groups.setdefault(title, []).append(i)
+        return groups
+
+    def _filled_rows(self, title: str) -> int:
+        if title != DEFAULT_WORKSHEET:
+            self._load_shards()
+            if title not in self._shards:
+                self._load_shards(reload=True)
+            if title not in self._shards:
+                return 1  # Лист будет создан, в нем только заголовок
+        if self.mirror is not None and title in self._synced:
+            return self.mirror.row_count(title)
+        return self.get_filled_row_count(title)
+
+    @staticmethod
+    def prepare_row(row_data):
+        """Приводит числовые колонки строки к нужным типам.
 
-    def insert_row(self, row_data, index: int):
+        Для строки с неверными суммами бросает `ValueError`: такую строку
+        нужно отсеять до записи пачки, чтобы она не испортила остальные.
+        """
+        row_data = list(row_data)
+        row_data[5], row_data[11], row_data[12] = int(row_data[11]), int(row_data[11]), int(row_data[12])
+        return row_data
+
+    def insert_row(self, row_data, index: int, sheet: Optional[str] = None):
         """Вставляет строку данных на указанный индекс."""
         try:
-            row_data[5], row_data[11], row_data[12] = int(row_data[11]), int(row_data[11]), int(row_data[12])
-            logger.info(f"Вставка строки на позицию {index}: {row_data}")
-            self.worksheet.insert_row(row_data, index)
+            row_data = self.prepare_row(row_data)
+            logger.info(f"Вставка строки на позицию {index}")
+            # Содержимое строки нужно только при отладке и не форматируется без нее
+            logger.opt(lazy=True).debug("Строка: {}", lambda: row_data)
+            worksheet = self._sheet(sheet)
+            worksheet.insert_row(row_data, index)
             logger.info("Строка успешно вставлена")
         except Exception as e:
             logger.error(f"Ошибка при вставке строки: {e}")
+            self._forget_mirror(sheet)
+            raise
+        if self.mirror is not None:
+            self.mirror.insert(worksheet.title, index, [row_keys(row_data)])
+
+    def insert_rows(self, rows, index: int, sheet: Optional[str] = None):
+        """Вставляет пачку строк одним запросом, начиная с указанного индекса.
+
+        Строки должны быть уже подготовлены `prepare_row`.
+        """
+        try:
+            worksheet = self._sheet(sheet)
+            logger.info(
+                f"Вставка {len(rows)} строк на позицию {index} ({worksheet.title})"
+            )
+            worksheet.insert_rows(rows, index)
+            logger.info("Строки успешно вставлены")
+        except Exception as e:
+            logger.error(f"Ошибка при вставке строк: {e}")
+            self._forget_mirror(sheet)
             raise
+        if self.mirror is not None:
+            self.mirror.insert(worksheet.title, index, list(map(row_keys, rows)))
+
+    def _forget_mirror(self, sheet: Optional[str] = None):
+        # Неизвестно, дошла ли запись до таблицы — копию нужно перечитать
+        if self.mirror is not None and self.connected:
+            title = sheet or self.worksheet.title
+            self.mirror.reset(title)
+            self._synced.discard(title)
             
     def get_row_count(self):
         """Возвращает количество строк, включая пустые."""
@@ -38,13 +259,84 @@ class GoogleSheets:
             logger.error(f"Ошибка при получении количества строк: {e}")
             raise
 
-    def get_filled_row_count(self):
-        """Возвращает количество заполненных строк (игнорируя пустые строки)."""
+    def get_filled_row_count(self, sheet: Optional[str] = None, verify: bool = False):
+        """Возвращает количество заполненных строк (игнорируя пустые строки).
+
+        С локальной копией догружаются только новые строки; с `verify` копия
+        еще и сверяется с листом (`GoogleSheets.verify`).
+        """
+        if self.mirror is not None:
+            if verify:
+                self.verify(sheet)
+            else:
+                self.sync(sheet=sheet)
+            return self.mirror.row_count(self._sheet(sheet).title)
         try:
             logger.info("Получение количества заполненных строк")
-            filled_rows = len(self.worksheet.get_all_values())
+            filled_rows = len(self._sheet(sheet).get_all_values())
             logger.info(f"Количество заполненных строк: {filled_rows}")
             return filled_rows
         except Exception as e:
             logger.error(f"Ошибка при получении количества заполненных строк: {e}")
             raise
+
+    def verify(self, sheet: Optional[str] = None):
+        """Сверяет локальную копию с числом заполненных строк листа.
+
+        `sync` читает только строки ниже известных и не замечает строк,
+        удаленных или перемещенных вручную. Здесь читается первая колонка
+        листа: если число строк разошлось с копией, она догружается, а если
+        и после этого не совпадает — перечитывается целиком.
+        """
+        worksheet = self._sheet(sheet)
+        title = worksheet.title
+        letter = rowcol_to_a1(1, FIRST_COLUMN)[:-1]
+        try:
+            logger.info(f"Проверка копии листа {title}")
+            filled = len(worksheet.batch_get([f"{letter}:{letter}"])[0])
+        except Exception as e:
+            logger.error(f"Ошибка при проверке копии таблицы: {e}")
+            raise
+        if title in self._synced and self.mirror.row_count(title) == filled:
+            return
+        self.sync(sheet=sheet)
+        if self.mirror.row_count(title) != filled:
+            logger.warning(f"Копия листа {title} разошлась с таблицей, перечитываем")
+            self.sync(full=True, sheet=sheet)
+
+    def sync(self, full: bool = False, sheet: Optional[str] = None) -> int:
+        """Догружает в локальную копию строки ниже уже известных.
+
+        Читаются только колонки с ключами и только новые строки; `full`
+        перечитывает лист целиком. Возвращает количество прочитанных строк.
+        """
+        worksheet = self._sheet(sheet)
+        title = worksheet.title
+        if full:
+            self.mirror.reset(title)
+        start = self.mirror.row_count(title) + 1
+        try:
+            logger.info(f"Сверка копии таблицы со строки {start}")
+            ranges = []
+            for column in MIRROR_COLUMNS:
+                letter = rowcol_to_a1(1, column)[:-1]
+                ranges.append(f"{letter}{start}:{letter}")
+            columns = [
+                [row[0] if row else "" for row in value_range]
+                for value_range in worksheet.batch_get(ranges)
+            ]
+        except Exception as e:
+            logger.error(f"Ошибка при сверке копии таблицы: {e}")
+            raise
+        count = max(map(len, columns), default=0)
+        if count:
+            cells = [column + [""] * (count - len(column)) for column in columns]
+            # Первая колонка нужна только для подсчета строк
+            self.mirror.append(title, start, zip(*cells[1:]))
+        self._synced.add(title)
+        logger.info(f"Новых строк в таблице: {count}")
+        return count
+
+    def has_lead(self, lead_id) -> bool:
+        """Есть ли в таблице строка сделки (по локальной копии)"""
+        return self.mirror.has_lead(lead_id)
@@ -0,0 +1,168 @@
+import json
+import sqlite3
+import time
+from typing import List, Optional
+from loguru import logger
+
+
+# Этапы обработки, выполнение которых отмечается отдельно
+STAGES = ("telegram_sent", "sheet_written")
+# Колонки, добавленные после создания таблицы, и их определения
+ADDED_COLUMNS = {"dedup_key": "TEXT", "owner": "TEXT", "lease_until": "REAL"}
+
+
+class JobStore:
+    """Очередь заданий на обработку сделок, хранящаяся на диске.
+
+    Используется SQLite в режиме WAL. Задание считается выполненным только
+    после всех этапов, поэтому после перезапуска незавершенные задания
+    обрабатываются снова (доставка «хотя бы один раз»), а уже выполненные
+    этапы и полученные из AmoCRM данные повторно не запрашиваются.
+
+    Задание берется в работу атомарно (`begin`): за ним записывается
+    владелец и срок аренды. Пока аренда действует, другие воркеры это
+    задание не берут; если воркер упал, задание вернется в работу после
+    истечения аренды.
+    """
+
+    def __init__(self, path: str = "jobs.db"):
+        self.path = path
+        self._conn = sqlite3.connect(path, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                lead_id INTEGER NOT NULL,
+                payload TEXT,
+                telegram_sent INTEGER NOT NULL DEFAULT 0,
+                sheet_written INTEGER NOT NULL DEFAULT 0,
+                done INTEGER NOT NULL DEFAULT 0,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL,
+                dedup_key TEXT,
+                owner TEXT,
+                lease_until REAL
+            )
+            """
+        )
+        # Колонки, появившиеся позже: добавляются в уже существующую базу
+        columns = {
+            row["name"] for row in self._conn.execute("PRAGMA table_info(jobs)")
+        }
+        for name, definition in ADDED_COLUMNS.items():
+            if name not in columns:
+                self._conn.execute(f"ALTER TABLE jobs ADD COLUMN {name} {definition}")
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS jobs_pending ON jobs (id) WHERE done = 0"
+        )
+        logger.info(f"Очередь заданий открыта: {path}")
+
+    def add(self, lead_id: int, dedup_key: Optional[str] = None) -> int:
+        """Добавляет задание на обработку сделки и возвращает его `id`.
+
+        `dedup_key` — ключ уведомления в индексе повторов: если задание не
+        удастся выполнить, ключ удаляется, чтобы повтор уведомления приняли.
+        """
+        cursor = self._conn.execute(
+            "INSERT INTO jobs (lead_id, created_at, dedup_key) VALUES (?, ?, ?)",
+            (lead_id, time.time(), dedup_key),
+        )
+        return cursor.lastrowid
+
+    def get(self, job_id: int) -> Optional[sqlite3.Row]:
+        """Возвращает задание по `id`"""
+        return self._conn.execute(
+            "SELECT * FROM jobs WHERE id = ?", (job_id,)
+        ).fetchone()
+
+    def begin(self, job_id: int, owner: str, lease: float) -> Optional[sqlite3.Row]:
+        """Берет задание в работу на `lease` секунд и возвращает его.
+
+        Возвращает `None`, если задание уже выполнено или его обрабатывает
+        другой владелец. Проверка и запись — один запрос, поэтому из
+        нескольких процессов задание получит только один.
+        """
+        now = time.time()
+        cursor = self._conn.execute(
+            "UPDATE jobs SET attempts = attempts + 1, owner = ?, lease_until = ? "
+            "WHERE id = ? AND done = 0 AND (owner IS NULL OR lease_until < ?)",
+            (owner, now + lease, job_id, now),
+        )
+        if cursor.rowcount == 0:
+            return None
+        return self.get(job_id)
+
+    def release(self, job_id: int):
+        """Снимает аренду: повторную попытку может выполнить любой воркер"""
+        self._conn.execute(
+            "UPDATE jobs SET owner = NULL, lease_until = NULL WHERE id = ?", (job_id,)
+        )
+
+    def release_others(self, owner: str) -> int:
+        """Снимает аренду с заданий всех владельцев, кроме `owner`.
+
+        Нужно при запуске единственного процесса: аренды, оставшиеся от
+        предыдущего запуска, никто уже не продлит и не снимет.
+        """
+        cursor = self._conn.execute(
+            "UPDATE jobs SET owner = NULL, lease_until = NULL "
+            "WHERE done = 0 AND owner IS NOT NULL AND owner != ?",
+            (owner,),
+        )
+        return cursor.rowcount
+
+    def set_payload(self, job_id: int, payload: dict):
+        """Сохраняет полученные из AmoCRM данные сделки"""
+        self._conn.execute(
+            "UPDATE jobs SET payload = ? WHERE id = ?",
+            (json.dumps(payload, ensure_ascii=False), job_id),
+        )
+
+    def mark(self, job_id: int, stage: str):
+        """Отмечает этап обработки как выполненный"""
+        if stage not in STAGES:
+            raise ValueError(f"Неизвестный этап: {stage}")
+        self._conn.execute(f"UPDATE jobs SET {stage} = 1 WHERE id = ?", (job_id,))
+
+    def complete(self, job_id: int):
+        """Отмечает задание как выполненное"""
+        self._conn.execute(
+            "UPDATE jobs SET done = 1, owner = NULL, lease_until = NULL WHERE id = ?",
+            (job_id,),
+        )
+
+    def pending(
+        self, stale: float = 0.0, max_attempts: Optional[int] = None
+    ) -> List[int]:
+        """Возвращает `id` незавершенных заданий без действующей аренды.
+
+        Задания, еще не взятые в работу, возвращаются, только если они
+        созданы больше `stale` секунд назад, а с `max_attempts` — только
+        если попыток было меньше.
+        """
+        query = (
+            "SELECT id FROM jobs WHERE done = 0 "
+            "AND COALESCE(lease_until, created_at + ?) < ?"
+        )
+        params = [stale, time.time()]
+        if max_attempts is not None:
+            query += " AND attempts < ?"
+            params.append(max_attempts)
+        return [
+            row["id"] for row in self._conn.execute(query + " ORDER BY id", params)
+        ]
+
+    def purge(self, older_than: float = 7 * 24 * 3600):
+        """Удаляет выполненные задания старше `older_than` секунд"""
+        cursor = self._conn.execute(
+            "DELETE FROM jobs WHERE done = 1 AND created_at < ?",
+            (time.time() - older_than,),
+        )
+        if cursor.rowcount:
+            logger.info(f"Удалено выполненных заданий: {cursor.rowcount}")
+
+    def close(self):
+        self._conn.close()
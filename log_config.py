@@ -0,0 +1,85 @@
+"""Настройка логирования.
+
+Все приемники работают с `enqueue=True`: запись в файл и в консоль идет из
+отдельного потока loguru, а цикл событий только кладет запись в очередь.
+Переменные окружения:
+
+- `log_level` — минимальный уровень (по умолчанию INFO);
+- `log_json=1` — писать записи в файл в виде JSON (по строке на запись)
+  вместе с полями `extra`, например `lead_id` и `job_id`;
+- `log_sample_rate=N` — из частых INFO-записей, помеченных `sampled=True`,
+  сохранять каждую N-ю (предупреждения и ошибки не прореживаются).
+
+Идентификаторы сделки и задания подставляются через
+`logger.contextualize(lead_id=..., job_id=...)` и попадают во все записи,
+сделанные при обработке сделки, в том числе из дочерних задач.
+"""
+
+import os
+import sys
+from typing import Dict, Tuple
+from loguru import logger
+
+TEXT_FORMAT = (
+    "{time:YYYY-MM-DD HH:mm:ss} | {level} | "
+    "lead={extra[lead_id]} job={extra[job_id]} | {message}"
+)
+WARNING = 30
+
+
+class Sampler:
+    """Фильтр loguru, оставляющий каждую `rate`-ю запись из одного места кода.
+
+    Прореживаются только записи уровня ниже WARNING, привязанные через
+    `logger.bind(sampled=True)`; счетчик ведется по функции и строке.
+    Каждому приемнику нужен свой экземпляр: фильтр вызывается для каждого.
+    """
+
+    def __init__(self, rate: int = 1):
+        self.rate = max(1, rate)
+        self._counts: Dict[Tuple[str, int], int] = {}
+
+    def __call__(self, record) -> bool:
+        if self.rate == 1 or record["level"].no >= WARNING:
+            return True
+        if not record["extra"].get("sampled"):
+            return True
+        key = (record["function"], record["line"])
+        count = self._counts.get(key, 0)
+        self._counts[key] = count + 1
+        return count % self.rate == 0
+
+
+def setup_logging():
+    """Заменяет приемник по умолчанию асинхронными приемниками в консоль и файл"""
+    level = os.getenv("log_level", "INFO")
+    serialize = os.getenv("log_json", "0") == "1"
+    sample_rate = int(os.getenv("log_sample_rate", "10"))
+
+    # Получение имени текущей директории
+    current_directory_name = os.path.basename(os.getcwd())
+    log_file_path = os.path.join(
+        "logs", f"{current_directory_name}_{{time:YYYY-MM-DD}}.log"
+    )
+
+    logger.remove()
+    logger.configure(extra={"lead_id": "-", "job_id": "-"})
+    logger.add(
+        sys.stdout,
+        format=TEXT_FORMAT,
+        level=level,
+        filter=Sampler(sample_rate),
+        enqueue=True,
+    )
+    # Настройка ротации логов
+    logger.add(
+        log_file_path,  # Файл лога будет называться по дате и сохраняться в поддиректории с названием текущей директории
+        rotation="00:00",  # Ротация каждый день в полночь
+        retention="7 days",  # Хранение логов за последние 7 дней
+        format=TEXT_FORMAT,  # Формат сообщений в файле (в режиме JSON не используется)
+        serialize=serialize,
+        level=level,  # Минимальный уровень логирования
+        filter=Sampler(sample_rate),
+        compression="zip",  # Архивирование старых логов
+        enqueue=True,  # Запись в файл из фонового потока, не из цикла событий
+    )
@@ -0,0 +1,136 @@
+"""Задержки цикла событий и выборочный профилировщик.
+
+`LoopMonitor` раз в `interval` секунд отмечается из цикла событий, а
+отдельный поток-сторож следит за отметками. Если цикл не отмечался дольше
+`threshold` секунд, значит, его заблокировал синхронный вызов: сторож
+снимает стек потока цикла (`sys._current_frames`) — в нем видна корутина,
+которая держит цикл, — и после возобновления записывает остановку с ее
+длительностью.
+
+`sample_profile` несколько секунд снимает стеки всех потоков процесса и
+возвращает их в свернутом виде (`поток;файл:функция:строка;... количество`),
+который понимают flamegraph.pl и speedscope.
+"""
+
+import asyncio
+import sys
+import threading
+import time
+import traceback
+from collections import Counter, deque
+from typing import Deque, Dict, List, Optional
+from loguru import logger
+from metrics import REGISTRY
+
+LOOP_LAG = REGISTRY.histogram(
+    "event_loop_lag_seconds",
+    "Опоздание отметок цикла событий",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+LOOP_STALLS = REGISTRY.counter(
+    "event_loop_stalls_total", "Остановки цикла событий дольше порога"
+)
+
+
+class LoopMonitor:
+    def __init__(
+        self, interval: float = 0.1, threshold: float = 0.25, history: int = 50
+    ):
+        self.interval = interval
+        self.threshold = threshold
+        self.stalls: Deque[dict] = deque(maxlen=history)
+        self.max_lag = 0.0
+        self._beat = time.monotonic()
+        self._loop_thread: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stop = threading.Event()
+        self._watchdog: Optional[threading.Thread] = None
+
+    def start(self):
+        """Запуск из работающего цикла событий"""
+        if self._task is not None:
+            return
+        self._loop_thread = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stop.clear()
+        self._task = asyncio.create_task(self._heartbeat())
+        self._watchdog = threading.Thread(
+            target=self._watch, name="loop-watchdog", daemon=True
+        )
+        self._watchdog.start()
+        logger.info(f"Контроль цикла событий запущен, порог {self.threshold} с")
+
+    async def stop(self):
+        self._stop.set()
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _heartbeat(self):
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(0.0, now - started - self.interval)
+            self._beat = now
+            LOOP_LAG.observe(lag)
+            if lag > self.max_lag:
+                self.max_lag = lag
+
+    def _watch(self):
+        stall: Optional[dict] = None
+        while not self._stop.wait(self.interval / 2):
+            blocked = time.monotonic() - self._beat
+            if blocked > self.threshold:
+                if stall is None:
+                    # Стек снимается, пока цикл еще заблокирован
+                    stall = {
+                        "started_at": time.time() - blocked,
+                        "stack": self._loop_stack(),
+                    }
+            elif stall is not None:
+                stall["duration_s"] = round(time.time() - stall["started_at"], 3)
+                self.stalls.append(stall)
+                LOOP_STALLS.inc()
+                logger.warning(
+                    f"Цикл событий был заблокирован {stall['duration_s']} с:\n"
+                    + "".join(stall["stack"])
+                )
+                stall = None
+
+    def _loop_stack(self) -> List[str]:
+        frame = sys._current_frames().get(self._loop_thread)
+        return traceback.format_stack(frame) if frame is not None else []
+
+    def stats(self) -> dict:
+        return {
+            "max_lag_ms": round(self.max_lag * 1000, 1),
+            "stalls": len(self.stalls),
+        }
+
+
+def _collapse(frame) -> str:
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f"{code.co_filename}:{code.co_name}:{frame.f_lineno}")
+        frame = frame.f_back
+    return ";".join(reversed(stack))
+
+
+def sample_profile(seconds: float, interval: float = 0.005) -> str:
+    """Выборочный профиль всех потоков процесса (блокирует вызвавший поток)"""
+    samples: Counter = Counter()
+    me = threading.get_ident()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names: Dict[int, str] = {t.ident: t.name for t in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == me:
+                continue
+            samples[f"{names.get(thread_id, thread_id)};{_collapse(frame)}"] += 1
+        time.sleep(interval)
+    return "".join(
+        f"{stack} {count}\n" for stack, count in samples.most_common()
+    )
@@ -1,159 +1,792 @@
 import os
-from fastapi import FastAPI, Request
-from fastapi.responses import JSONResponse
+import re
+import hmac
+import json
+import time
+import uuid
+import socket
+import asyncio
+from typing import Optional
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, PlainTextResponse
 from amocrm import AmoCRMClient
-from amocrm.models import Lead, BranchIsNotOnline
+from amocrm.models import Lead, BranchIsNotOnline, is_online
+import gspread
 from aiogram import Bot
+from aiogram.exceptions import (
+    TelegramNetworkError,
+    TelegramRetryAfter,
+    TelegramServerError,
+)
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from dotenv import load_dotenv
 from loguru import logger
-from sys import stdout
 from google_sheets import GoogleSheets
-from datetime import datetime
+from sheet_mirror import SheetMirror
+from sheet_writer import SheetWriter
+from pipeline import LeadPipeline, gather_partial
+from job_store import JobStore
+from telegram_sender import TelegramDispatcher, render_lead
+from dedup import DedupIndex
+from metrics import ERRORS, REGISTRY, MetricsMiddleware
+from log_config import setup_logging
+from coordination import create_coordinator
+from poller import EventPoller
+from resilience import TRANSIENT_ERRORS, CircuitBreaker, DeadLetterStore, Redriver
+from loop_monitor import LoopMonitor, sample_profile
+
 
+# Время запуска: от него отсчитывается время холодного старта
+STARTED_AT = time.monotonic()
 
 # Загрузка переменных из .env файла
 load_dotenv()
 
-# Получение имени текущей директории
-current_directory_name = os.path.basename(os.getcwd())
+setup_logging()
 
-os.makedirs(".", exist_ok=True)  # Создание папки logs, если её нет
+app = FastAPI()
+app.add_middleware(MetricsMiddleware)
+# Бот и подключение к таблице создаются при старте приложения, а не при импорте
+bot: Optional[Bot] = None
 
-log_file_path = os.path.join(
-    "logs", f"{current_directory_name}_{{time:YYYY-MM-DD}}.log"
-)
 
+def create_bot() -> Bot:
+    if os.getenv("telegram_api_url"):
+        # Другой сервер Bot API (локальный сервер или заглушка для нагрузочных тестов)
+        return Bot(
+            os.getenv("telegram_token"),
+            session=AiohttpSession(
+                api=TelegramAPIServer.from_base(os.getenv("telegram_api_url"))
+            ),
+        )
+    return Bot(os.getenv("telegram_token"))
 
-# Настройка ротации логов
-logger.add(
-    log_file_path,  # Файл лога будет называться по дате и сохраняться в поддиректории с названием текущей директории
-    rotation="00:00",  # Ротация каждый день в полночь
-    retention="7 days",  # Хранение логов за последние 7 дней
-    format="{time:YYYY-MM-DD HH:mm:ss} | {level} | {message}",  # Формат сообщений в файле
-    level="INFO",  # Минимальный уровень логирования
-    compression="zip",  # Архивирование старых логов
-)
 
-app = FastAPI()
-bot = Bot(os.getenv("telegram_token"))
+# Фоновые задачи приложения. Цикл событий хранит на задачи только слабые
+# ссылки: без этого набора задачу мог бы собрать сборщик мусора
+background_tasks: set[asyncio.Task] = set()
+
+
+def spawn(coro) -> asyncio.Task:
+    """Запускает фоновую задачу; незавершенные отменяются при остановке"""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(task_done)
+    return task
+
+
+def task_done(task: asyncio.Task):
+    background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        ERRORS.inc(type(task.exception()).__name__)
+        logger.error(
+            f"Фоновая задача {task.get_coro().__name__} завершилась ошибкой: "
+            f"{task.exception()}"
+        )
+
+
+# Несколько воркеров uvicorn делят номер строки таблицы, индекс повторов,
+# лимиты запросов и токен AmoCRM через общее состояние
+WEB_WORKERS = int(os.getenv("web_workers", "1"))
+coordinator = create_coordinator(
+    os.getenv("coordination", "sqlite" if WEB_WORKERS > 1 else ""),
+    path=os.getenv("coordination_path", "coordination.db"),
+    redis_url=os.getenv("redis_url"),
+)
 GROUP_CHAT_ID =int(os.getenv("group"))
-google = GoogleSheets()
+telegram = TelegramDispatcher(
+    None,
+    rate_per_minute=float(os.getenv("telegram_rate_per_minute", "20")),
+    coalesce_threshold=int(os.getenv("telegram_coalesce_threshold", "5")),
+    coordinator=coordinator,
+)
+google = GoogleSheets(
+    mirror=SheetMirror(os.getenv("sheet_mirror_path", "sheet_mirror.db")),
+    # Разбиение по листам: по месяцу оплаты и/или по числу строк в листе
+    shard_by=os.getenv("sheet_shard_by", ""),
+    max_rows=int(os.getenv("sheet_max_rows", "0")),
+)
+sheet_writer = SheetWriter(
+    google,
+    flush_interval=float(os.getenv("sheet_flush_interval", "2")),
+    max_batch=int(os.getenv("sheet_max_batch", "100")),
+    max_queue=int(os.getenv("sheet_max_queue", "1000")),
+    coordinator=coordinator,
+)
 amo_client = AmoCRMClient(
-    base_url="https://teslakz.amocrm.ru",
+    base_url=os.getenv("amocrm_url", "https://teslakz.amocrm.ru"),
     access_token=os.getenv("access_token"),
     client_id=os.getenv("client_id"),
     client_secret=os.getenv("client_secret"),
     permanent_access_token=True,
+    rate_limiter=coordinator.bucket("amocrm", 7.0) if coordinator else None,
+    coordinator=coordinator,
 )
 
 
 @app.on_event("startup")
 async def startup_event():
-    """Событие при старте приложения"""
+    """Событие при старте приложения.
+
+    Внешние сервисы прогреваются в фоне, чтобы приложение сразу начало
+    принимать вебхуки; готовность видна в `/health/ready`.
+    """
+    global bot
+    bot = telegram.bot = create_bot()
+    loop_monitor.start()  # Следим за блокировками цикла событий
     amo_client.start_session()  # Создаем сессию при старте
-    bot_info = await bot.get_me()
-    logger.info(f"Бот[{bot_info.id}] @{bot_info.username}")
+    sheet_writer.start()  # Запускаем пакетную запись в таблицу
+    pipeline.start()  # Запускаем воркеров обработки сделок
+    redriver.start()  # Повторно отправляем отложенное
+    if poller is not None:
+        poller.start()  # Опрашиваем события AmoCRM
+    job_store.purge()
+    spawn(warm_up())  # Подключаемся к внешним сервисам
+    spawn(recover_jobs())  # Возвращаем в работу незавершенные задания
 
 
 @app.on_event("shutdown")
 async def shutdown_event():
     """Событие при завершении приложения"""
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    if poller is not None:
+        await poller.stop()
+    await pipeline.stop()  # Дожидаемся обработки принятых сделок
+    await redriver.stop()
+    await sheet_writer.stop()  # Дописываем строки из буфера
+    await telegram.stop()  # Отправляем оставшиеся сообщения
     await amo_client.close_session()  # Закрываем сессию при завершении
+    if bot is not None:
+        await bot.session.close()
+    job_store.close()
+    dead_letters.close()
+    google.mirror.close()
+    dedup.close()
+    if coordinator is not None:
+        coordinator.close()
+    await loop_monitor.stop()
+    await logger.complete()  # Дописываем записи из очереди логов
+
+
+async def check_telegram() -> bool:
+    bot_info = await bot.get_me()
+    logger.info(f"Бот[{bot_info.id}] @{bot_info.username}")
+    return True
+
+
+async def check_sheets() -> bool:
+    # gspread блокирует поток, подключаемся в пуле потоков
+    await asyncio.get_running_loop().run_in_executor(None, google.connect)
+    return True
+
+
+async def check_amocrm() -> bool:
+    if not await amo_client.warm_up():  # Устанавливаем соединение заранее
+        return False
+    spawn(prefetch_users())  # Заполняем кэш менеджеров
+    return True
+
+
+WARM_UP_CHECKS = {
+    "sheets": check_sheets,
+    "telegram": check_telegram,
+    "amocrm": check_amocrm,
+}
+readiness = {name: False for name in WARM_UP_CHECKS}
+startup_seconds: Optional[float] = None
+
+
+async def warm_up():
+    """Одновременное подключение к Google Таблице, Telegram и AmoCRM.
+
+    Неудавшиеся проверки повторяются, пока все сервисы не станут доступны.
+    Время от импорта приложения до готовности сравнивается с `startup_budget`.
+    """
+    global startup_seconds
+    while True:
+        checks = {
+            name: check()
+            for name, check in WARM_UP_CHECKS.items()
+            if not readiness[name]
+        }
+        results = await gather_partial(checks, STARTUP_TIMEOUT)
+        for name in checks:
+            readiness[name] = bool(results.get(name))
+        if all(readiness.values()):
+            break
+        failed = [name for name, ready in readiness.items() if not ready]
+        logger.warning(
+            f"Сервисы недоступны: {', '.join(failed)}, повтор через {STARTUP_RETRY} с"
+        )
+        await asyncio.sleep(STARTUP_RETRY)
+    startup_seconds = round(time.monotonic() - STARTED_AT, 3)
+    if startup_seconds > STARTUP_BUDGET:
+        logger.warning(
+            f"Приложение готово за {startup_seconds} с (бюджет {STARTUP_BUDGET} с)"
+        )
+    else:
+        logger.info(f"Приложение готово за {startup_seconds} с")
+
+
+async def prefetch_users():
+    """Загрузка списка пользователей AmoCRM в кэш"""
+    try:
+        await amo_client.prefetch_users()
+    except Exception as e:
+        logger.warning(f"Не удалось загрузить пользователей AmoCRM: {e}")
+
+
+async def recover_jobs():
+    """Повторная постановка в очередь незавершенных заданий.
+
+    При запуске возвращаются задания, не завершенные до перезапуска (если
+    воркер один, их аренда снимается сразу, а не по истечении), а затем
+    раз в `job_lease` секунд — брошенные упавшим воркером: с истекшей арендой
+    или так и не взятые в работу. Одно задание может попасть в очереди
+    нескольких воркеров, но выполнит его только один (`JobStore.begin`).
+    """
+    if coordinator is None:
+        # Без координатора процесс один: аренды остались от прошлого запуска
+        released = job_store.release_others(WORKER_ID)
+        if released:
+            logger.info(f"Снята аренда с заданий прошлого запуска: {released}")
+    await requeue(job_store.pending())
+    while True:
+        await asyncio.sleep(JOB_LEASE)
+        # Очередь заданий общая: брошенные задания ищет один воркер
+        if coordinator is None or await coordinator.claim("recover_jobs", JOB_LEASE):
+            await requeue(
+                job_store.pending(stale=JOB_LEASE, max_attempts=pipeline.max_attempts)
+            )
+
+
+async def requeue(pending: list[int]):
+    if pending:
+        logger.info(f"Восстановление незавершенных заданий: {len(pending)}")
+    for job_id in pending:
+        await pipeline.submit(job_id)
 
 
 async def send_to_telegram(lead: Lead):
-    await bot.send_message(
-        GROUP_CHAT_ID,
-        f"<u>Примите нового ученика</u>.😊\n"
-        f"Дата оплаты: <b>{lead.payment.date}</b>\n\n"
-        f"🤓Ученик: <b>{lead.learner.last_name} {lead.learner.first_name}</b>\n"
-        f"✔️Класс и отделение: <b>{lead.learner.grade} {lead.learner.departament}</b>\n"
-        f"⏰Время: <b>{lead.learning_time}</b>\n"
-        f"👩‍👦 Родитель: <b>{lead.parent.name}</b>\n"
-        f"📞 Телефон: <b>{lead.parent.phone}</b>\n"
-        f"🏠 Филиал: <b>{lead.branch}</b>\n\n"
-        f"🔷 Срок обучения: <b>{'' if lead.learning_duration == '' else lead.learning_duration + ' мес.'}</b>\n\n"
-        f"🟢 Дата начала обучения: <b>{lead.start_date}</b>\n"
-        f"🔴 Дата конца обучения: <b>{lead.end_date}</b>\n\n"
-        f"🎯Направление обучения: <b>{lead.learner.learning_direction}</b>\n"
-        f"📚Профильные предметы: <b>{lead.learner.profile_subjects}</b>\n"
-        f"ℹ️Новый или продление: <b>{lead.status}</b>\n"
-        f"📨Комментарий ОП: <b>{lead.manager.comment}</b>\n\n"
-        f"😎Менеджер: <b>{lead.manager.name}</b>",
-        parse_mode="HTML",
+    await telegram.send_lead(GROUP_CHAT_ID, lead)
+
+
+async def send_to_google(lead: Lead):
+    await sheet_writer.write(lead.to_row())
+
+
+async def fetch_lead(lead_id: int, data: Optional[dict] = None) -> tuple[Lead, dict]:
+    """Получение сделки, менеджера и контакта из AmoCRM.
+
+    Если сделка уже загружена (опрос событий получает их пачкой), передается
+    в `data`, и запрашиваются только менеджер и контакт.
+    """
+    if data is None:
+        with pipeline.stage("get_lead"):
+            data = await amo_client.get_lead(lead_id)
+    # Большинство сделок не онлайн — отсекаем их до разбора и лишних запросов
+    if not is_online(data):
+        pipeline.count("filtered_branch")
+        raise BranchIsNotOnline(f"Сделка #{lead_id}: филиал не онлайн")
+    with pipeline.stage("parse_lead"):
+        lead = Lead.from_json(data)
+    # Менеджер и контакт не зависят друг от друга — запрашиваем одновременно
+    lookups = {}
+    if lead.manager.id:
+        lookups["user"] = pipeline.timed(
+            "get_user", amo_client.get_user(lead.manager.id)
+        )
+    if lead.parent.id:
+        lookups["contact"] = pipeline.timed(
+            "get_contact", amo_client.get_contact(lead.parent.id)
+        )
+    results = await gather_partial(lookups, ENRICHMENT_TIMEOUT)
+    payload = {
+        "lead": data,
+        "user": results.get("user", {}),
+        "contact": results.get("contact", {}),
+    }
+    if payload["user"]:
+        lead.manager.set_name(payload["user"])
+    if payload["contact"]:
+        lead.parent.set_email(payload["contact"])
+    return lead, payload
+
+
+def build_lead(payload: dict) -> Lead:
+    """Восстановление сделки из сохраненных данных AmoCRM"""
+    lead = Lead.from_json(payload["lead"])
+    if payload["user"]:
+        lead.manager.set_name(payload["user"])
+    if payload["contact"]:
+        lead.parent.set_email(payload["contact"])
+    return lead
+
+
+async def process_job(job_id: int, wait: bool = False):
+    """Обработка задания: получение сделки и отправка в Telegram и Google Таблицу.
+
+    Выполненные этапы отмечаются в очереди заданий и при повторной обработке
+    пропускаются. Отправку воркер очереди не ждет (`LeadPipeline.defer`);
+    с `wait` она выполняется сразу и ее ошибка достается вызывающему.
+    """
+    job = job_store.begin(job_id, WORKER_ID, JOB_LEASE)
+    if job is None:
+        return  # Задание выполнено или его обрабатывает другой воркер
+    # Все записи об обработке сделки, включая дочерние задачи, помечаются ее id
+    with logger.contextualize(lead_id=job["lead_id"], job_id=job_id):
+        try:
+            await _process_job(job_id, job, wait)
+        except Exception:
+            job_store.release(job_id)  # Повторить может любой воркер
+            raise
+
+
+async def _process_job(job_id: int, job, wait: bool = False):
+    payload = json.loads(job["payload"]) if job["payload"] is not None else None
+    # Без менеджера и контакта в задании лежит только сделка из опроса событий
+    if payload is None or "user" not in payload:
+        try:
+            lead, payload = await fetch_lead(
+                job["lead_id"], payload["lead"] if payload else None
+            )
+        except BranchIsNotOnline:
+            job_store.complete(job_id)
+            return
+        job_store.set_payload(job_id, payload)
+    else:
+        lead = build_lead(payload)
+    if wait:
+        await deliver(job_id, job, lead)
+        return
+    # Отправка ждет пачек Telegram и таблицы — воркер тем временем свободен
+    pipeline.defer(job_id, deliver(job_id, job, lead))
+
+
+async def deliver(job_id: int, job, lead: Lead):
+    """Отправка сделки в Telegram и Google Таблицу и завершение задания"""
+    try:
+        await _deliver(job_id, job, lead)
+    except Exception:
+        job_store.release(job_id)
+        raise
+
+
+async def _deliver(job_id: int, job, lead: Lead):
+    # Telegram и Google Таблица независимы: ошибка одного не мешает другому
+    sinks = {}
+    if not job["telegram_sent"]:
+        sinks["telegram_sent"] = pipeline.timed(
+            "telegram", breakers["telegram_sent"].call(send_to_telegram(lead))
+        )
+    if not job["sheet_written"]:
+        sinks["sheet_written"] = pipeline.timed(
+            "google", breakers["sheet_written"].call(send_to_google(lead))
+        )
+    results = await asyncio.gather(*sinks.values(), return_exceptions=True)
+    for stage, result in zip(sinks, results):
+        if isinstance(result, Exception):
+            # Недоставленное откладывается и будет отправлено повторно, когда
+            # сервис снова станет доступен; задание при этом завершается
+            ERRORS.inc(type(result).__name__)
+            dead_letters.add(stage, sink_payload(stage, lead), str(result), job_id)
+            pipeline.count("dead_letters")
+            logger.warning(f"Этап {stage} отложен: {result}")
+        else:
+            job_store.mark(job_id, stage)
+    job_store.complete(job_id)
+    pipeline.count("processed_leads")
+
+
+async def job_failed(job_id: int):
+    """Задание не удалось выполнить за все попытки"""
+    job = job_store.get(job_id)
+    if job is not None and job["dedup_key"]:
+        # Повторное уведомление о сделке (от AmoCRM или из опроса событий)
+        # снова будет принято, а не отброшено как уже обработанное
+        await dedup.forget(job["dedup_key"])
+
+
+def sink_payload(stage: str, lead: Lead):
+    """Данные для повторной отправки получателю без обращения к AmoCRM"""
+    if stage == "telegram_sent":
+        return {"chat_id": GROUP_CHAT_ID, "text": render_lead(lead)}
+    return {"row": list(lead.to_row())}
+
+
+job_store = JobStore(os.getenv("job_store_path", "jobs.db"))
+# Владелец аренды заданий: уникален для процесса и для каждого его запуска
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+# Срок аренды задания; должен превышать время его обработки
+JOB_LEASE = float(os.getenv("job_lease", "600"))
+# Предохранители получателей: при недоступном сервисе вызовы сразу отклоняются
+# Ошибки, после которых получатель считается недоступным; ошибки в данных
+# (например, неверная разметка сообщения) предохранитель не размыкают
+SINK_ERRORS = {
+    "telegram_sent": TRANSIENT_ERRORS
+    + (TelegramNetworkError, TelegramRetryAfter, TelegramServerError),
+    "sheet_written": TRANSIENT_ERRORS + (gspread.exceptions.APIError,),
+}
+breakers = {
+    stage: CircuitBreaker(
+        stage,
+        failure_threshold=int(os.getenv("breaker_failures", "5")),
+        reset_timeout=float(os.getenv("breaker_reset_timeout", "30")),
+        transient=errors,
     )
+    for stage, errors in SINK_ERRORS.items()
+}
+dead_letters = DeadLetterStore(os.getenv("dead_letters_path", "dead_letters.db"))
+redriver = Redriver(
+    dead_letters,
+    breakers,
+    {
+        "telegram_sent": lambda p: telegram.send(p["chat_id"], p["text"]),
+        "sheet_written": lambda p: sheet_writer.write(p["row"]),
+    },
+    interval=float(os.getenv("redrive_interval", "30")),
+    max_attempts=int(os.getenv("redrive_max_attempts", "10")),
+    coordinator=coordinator,
+)
+# Повторные доставки одного и того же перехода сделки по статусам
+dedup = DedupIndex(
+    ttl=float(os.getenv("dedup_ttl", "3600")),
+    path=os.getenv("dedup_path") or None,
+    coordinator=coordinator,
+)
+pipeline = LeadPipeline(
+    process_job,
+    workers=int(os.getenv("workers", "4")),
+    max_queue=int(os.getenv("max_queue", "1000")),
+    max_attempts=int(os.getenv("job_attempts", "3")),
+    retry_delay=float(os.getenv("job_retry_delay", "5")),
+    on_failure=job_failed,
+)
+FAST_ACK = os.getenv("fast_ack", "1") == "1"
+# Если заданы, сделки из других воронок/статусов отбрасываются прямо в вебхуке
+ALLOWED_PIPELINES = {p for p in os.getenv("allowed_pipelines", "").split(",") if p}
+ALLOWED_STATUSES = {s for s in os.getenv("allowed_statuses", "").split(",") if s}
+ENRICHMENT_TIMEOUT = float(os.getenv("enrichment_timeout", "10"))
+# Прогрев внешних сервисов при старте
+STARTUP_TIMEOUT = float(os.getenv("startup_timeout", "30"))
+STARTUP_RETRY = float(os.getenv("startup_retry", "10"))
+STARTUP_BUDGET = float(os.getenv("startup_budget", "5"))
+# Остановки цикла событий дольше порога записываются со стеком
+loop_monitor = LoopMonitor(
+    threshold=float(os.getenv("loop_stall_threshold", "0.25"))
+)
+# Без токена служебные эндпоинты отключены
+ADMIN_TOKEN = os.getenv("admin_token", "")
+PROFILE_MAX_SECONDS = 60
+profile_lock = asyncio.Lock()
+
 
+def is_allowed(lead_status: dict) -> bool:
+    """Проверка воронки и статуса сделки по данным из формы вебхука"""
+    if ALLOWED_PIPELINES and lead_status.get("pipeline_id") not in ALLOWED_PIPELINES:
+        return False
+    if ALLOWED_STATUSES and lead_status.get("status_id") not in ALLOWED_STATUSES:
+        return False
+    return True
 
-def send_to_google(lead: Lead):
-    data_insert = [
-        datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-        lead.payment.date,
-        lead.manager.name,
-        "",
-        lead.learner.last_name + ' ' +  lead.learner.first_name,
-        lead.learner.learning_direction,
-        lead.learner.grade,
-        lead.learner.departament,
-        lead.learning_time,
-        lead.branch,
-        lead.learner.profile_subjects,
-        lead.payment.amount,
-        lead.payment.credit,
-        lead.payment.method,
-        lead.base_course,
-        lead.intensive_cource,
-        lead.summer_camp,
-        lead.status,
-        "",
-        lead.start_date,
-        lead.end_date,
-        lead.parent.name,
-        "",
-        lead.parent.phone,
-        lead.manager.comment,
-        lead.parent.email,
-    ]
-    google.insert_row(data_insert, google.get_filled_row_count() + 1)
+
+LEADS_STATUS_KEY = re.compile(r"^leads\[status\]\[(\d+)\]\[(\w+)\]$")
+
+
+def parse_leads_status(data: dict) -> list[dict]:
+    """Разбор полей `leads[status][N][...]` формы в список сделок.
+
+    Каждая сделка — словарь с ключами `id`, `status_id`, `pipeline_id`,
+    `old_status_id`, `old_pipeline_id` (какие есть в форме).
+    """
+    leads = {}
+    for key, value in data.items():
+        match = LEADS_STATUS_KEY.match(key)
+        if match:
+            leads.setdefault(int(match.group(1)), {})[match.group(2)] = value
+    return [lead for _, lead in sorted(leads.items()) if lead.get("id")]
+
+
+async def accept_lead(lead_status: dict) -> Optional[int]:
+    """Фильтры и отбрасывание повторов; возвращает номер созданного задания.
+
+    Общая часть вебхука и опроса событий: переход сделки, уже принятый одним
+    способом, другим не обрабатывается повторно.
+    """
+    if not is_allowed(lead_status):
+        pipeline.count("filtered_status")
+        return None
+    dedup_key = f"{lead_status['id']}:{lead_status.get('status_id', '')}"
+    if await dedup.check(dedup_key):
+        pipeline.count("duplicates")
+        return None
+    with logger.contextualize(lead_id=lead_status["id"]):
+        logger.info(f"Новое уведомление: сделка #{lead_status['id']} завершена")
+    # Сначала сохраняем задание на диск, чтобы не потерять его при перезапуске
+    return job_store.add(int(lead_status["id"]), dedup_key)
+
+
+async def ingest_events(leads_status: list[dict]):
+    """Переходы сделок из опроса событий AmoCRM.
+
+    Сделки загружаются пачками до 250 штук и сохраняются в задания, после
+    чего задания обрабатываются так же, как из вебхука.
+    """
+    await submit_jobs(await accept_leads(leads_status))
+
+
+async def accept_leads(leads_status: list[dict]) -> list[tuple[int, int]]:
+    """Принимает переходы сделок; возвращает пары «сделка, задание»"""
+    jobs = []
+    for lead_status in leads_status:
+        job_id = await accept_lead(lead_status)
+        if job_id is not None:
+            jobs.append((int(lead_status["id"]), job_id))
+    return jobs
+
+
+async def prefetch_leads(jobs: list[tuple[int, int]]):
+    """Загружает сделки принятых заданий и сохраняет их в задания.
+
+    Запросы идут через пакетный загрузчик клиента сразу при приеме, поэтому
+    сделки из одного и из одновременных уведомлений загружаются одним
+    запросом. Если сделку получить не удалось, воркер запросит ее сам.
+    """
+    if not jobs:
+        return
+    with pipeline.stage("get_leads"):
+        results = await asyncio.gather(
+            *(amo_client.get_lead(lead_id) for lead_id, _ in jobs),
+            return_exceptions=True,
+        )
+    for (lead_id, job_id), data in zip(jobs, results):
+        if isinstance(data, Exception):
+            logger.warning(f"Сделка #{lead_id} не загружена заранее: {data}")
+        else:
+            job_store.set_payload(job_id, {"lead": data})
+
+
+async def submit_jobs(jobs: list[tuple[int, int]]):
+    """Загрузка сделок пачкой и постановка заданий в очередь"""
+    await prefetch_leads(jobs)
+    for _, job_id in jobs:
+        await pipeline.submit(job_id)
+
+
+# Опрос событий AmoCRM — прием сделок без вебхука или в дополнение к нему
+poller = (
+    EventPoller(
+        amo_client,
+        ingest_events,
+        interval=float(os.getenv("poll_interval", "30")),
+        cursor_path=os.getenv("events_cursor_path", "events_cursor.json"),
+        coordinator=coordinator,
+    )
+    if os.getenv("poll_events", "0") == "1"
+    else None
+)
 
 
 @app.post("/webhook")
 async def webhook(request: Request):
-    form_data = await request.form()
-    # Преобразуем данные в словарь
-    data = {key: value for key, value in form_data.items()}
-
-    # Обработка данных leads[status] и account
-    leads_status = {
-        "id": data.get("leads[status][0][id]"),
-        # "status_id": data.get("leads[status][0][status_id]"),
-        # "pipeline_id": data.get("leads[status][0][pipeline_id]"),
-        # "old_status_id": data.get("leads[status][0][old_status_id]"),
-        # "old_pipeline_id": data.get("leads[status][0][old_pipeline_id]"),
-    }
+    with pipeline.stage("form_parse"):
+        form_data = await request.form()
+        # Преобразуем данные в словарь
+        data = {key: value for key, value in form_data.items()}
+
+    # Обработка данных leads[status]: в одном уведомлении может быть несколько сделок
+    leads_status = parse_leads_status(data)
 
     # account_info = {
     #     "id": data.get("account[id]"),
     #     "subdomain": data.get("account[subdomain]"),
     # }
 
-    logger.info(f"Новое уведомление: сделка #{leads_status['id']} завершена")
+    jobs = await accept_leads(leads_status)
+    if FAST_ACK:
+        # Отвечаем сразу; сделки загружаются одним запросом и обработаются в фоне
+        if jobs:
+            spawn(submit_jobs(jobs))
+        return
+    # Без быстрого ответа AmoCRM ждет, пока сделки будут доставлены; задание с
+    # ошибкой вернет в работу `recover_jobs`, когда истечет `job_lease`
+    await prefetch_leads(jobs)
+    results = await asyncio.gather(
+        *(process_job(job_id, wait=True) for _, job_id in jobs),
+        return_exceptions=True,
+    )
+    for result in results:
+        if isinstance(result, Exception):
+            ERRORS.inc(type(result).__name__)
+            logger.error(f"Ошибка при обработке уведомления: {result}")
 
-    try:
-        lead = Lead.from_json(await amo_client.get_lead(leads_status["id"]))
-        if lead.manager.id:
-            lead.manager.set_name(await amo_client.get_user(lead.manager.id))
-        if lead.parent.id:
-            lead.parent.set_email(await amo_client.get_contact(lead.parent.id))
-        await send_to_telegram(lead)
-        send_to_google(lead)
-    except BranchIsNotOnline:
-        pass
-    except Exception as e:
-        logger.error(f"Ошибка при обработке уведомления: {e}")
+
+@app.get("/stats")
+async def stats():
+    """Состояние очереди обработки сделок"""
+    return JSONResponse(
+        {
+            **pipeline.stats(),
+            "sheet_queue_size": sheet_writer.queue_size,
+            "telegram": telegram.stats(),
+            "dedup": dedup.stats(),
+            "amocrm_cache": amo_client.cache_stats(),
+            "amocrm_requests": amo_client.request_stats(),
+            "events": poller.stats() if poller is not None else None,
+            "breakers": {name: b.stats() for name, b in breakers.items()},
+            "dead_letters": dead_letters.counts(),
+            "dead_letters_parked": dead_letters.counts(parked=True),
+            "redriven": redriver.redriven,
+            "event_loop": loop_monitor.stats(),
+        }
+    )
+
+
+@app.get("/health/live")
+async def health_live():
+    """Процесс запущен и цикл событий отвечает"""
+    return JSONResponse({"status": "ok"})
+
+
+@app.get("/health/ready")
+async def health_ready():
+    """Готовность принимать и обрабатывать сделки: все внешние сервисы подключены"""
+    ready = all(readiness.values())
+    return JSONResponse(
+        {"ready": ready, "services": readiness, "startup_seconds": startup_seconds},
+        status_code=200 if ready else 503,
+    )
+
+
+def check_admin(request: Request):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404)
+    # Сравнение за постоянное время не выдает токен по времени ответа
+    token = request.headers.get("X-Admin-Token", "")
+    if not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=403)
+
+
+@app.get("/admin/stalls")
+async def admin_stalls(request: Request):
+    """Последние остановки цикла событий со стеками"""
+    check_admin(request)
+    return JSONResponse(
+        [{**stall, "stack": "".join(stall["stack"])} for stall in loop_monitor.stalls]
+    )
+
+
+@app.get("/admin/profile")
+async def admin_profile(request: Request, seconds: float = 10):
+    """Выборочный профиль процесса за `seconds` секунд в свернутом формате"""
+    check_admin(request)
+    # Одновременно снимается один профиль: каждый занимает поток пула
+    if profile_lock.locked():
+        raise HTTPException(status_code=409, detail="Профиль уже снимается")
+    seconds = min(max(seconds, 0.1), PROFILE_MAX_SECONDS)
+    async with profile_lock:
+        # Профиль снимается в отдельном потоке, цикл событий продолжает работать
+        profile = await asyncio.to_thread(sample_profile, seconds)
+    return PlainTextResponse(profile)
+
+
+@app.get("/metrics")
+async def metrics():
+    """Метрики в формате Prometheus"""
+    return PlainTextResponse(
+        REGISTRY.render(), media_type="text/plain; version=0.0.4"
+    )
+
+
+@REGISTRY.collector("queue_size", "gauge", "Размер внутренних очередей")
+def collect_queue_sizes():
+    yield "queue_size", {"queue": "jobs"}, pipeline.stats()["queue_size"]
+    yield "queue_size", {"queue": "sheets"}, sheet_writer.queue_size
+    yield "queue_size", {"queue": "telegram"}, telegram.stats()["queue_size"]
+
+
+@REGISTRY.collector("service_ready", "gauge", "Готовность внешних сервисов")
+def collect_readiness():
+    for name, ready in readiness.items():
+        yield "service_ready", {"service": name}, int(ready)
+
+
+@REGISTRY.collector(
+    "startup_seconds", "gauge", "Время от запуска до готовности приложения"
+)
+def collect_startup():
+    if startup_seconds is not None:
+        yield "startup_seconds", {}, startup_seconds
+
+
+@REGISTRY.collector(
+    "circuit_open", "gauge", "Предохранитель получателя разомкнут (1) или замкнут (0)"
+)
+def collect_breakers():
+    for name, breaker in breakers.items():
+        yield "circuit_open", {"sink": name}, int(breaker.state != breaker.CLOSED)
+
+
+@REGISTRY.collector("dead_letters", "gauge", "Отложенные недоставленные данные")
+def collect_dead_letters():
+    for sink, count in dead_letters.counts().items():
+        yield "dead_letters", {"sink": sink}, count
+
+
+@REGISTRY.collector(
+    "dead_letters_parked", "gauge", "Недоставленные данные, исчерпавшие попытки"
+)
+def collect_parked_letters():
+    for sink, count in dead_letters.counts(parked=True).items():
+        yield "dead_letters_parked", {"sink": sink}, count
+
+
+@REGISTRY.collector("workers_busy", "gauge", "Занятые воркеры обработки сделок")
+def collect_workers():
+    yield "workers_busy", {}, pipeline.stats()["busy_workers"]
+
+
+@REGISTRY.collector("leads_total", "counter", "Сделки по результату обработки")
+def collect_leads():
+    yield "leads_total", {"result": "processed_jobs"}, pipeline.processed
+    yield "leads_total", {"result": "failed_jobs"}, pipeline.failed
+    for name, value in pipeline.counters.items():
+        yield "leads_total", {"result": name}, value
+
+
+@REGISTRY.collector("amocrm_responses_total", "counter", "Ответы AmoCRM по статусу")
+def collect_amocrm_statuses():
+    for status, count in amo_client.status_counts.items():
+        yield "amocrm_responses_total", {"status": str(status)}, count
+
+
+@REGISTRY.collector(
+    "amocrm_rate_limit_wait_seconds_total",
+    "counter",
+    "Ожидание лимита запросов AmoCRM",
+)
+def collect_amocrm_wait():
+    wait = amo_client.request_stats()["rate_limit"]["total_wait_s"]
+    yield "amocrm_rate_limit_wait_seconds_total", {}, wait
+
+
+@REGISTRY.collector("cache_requests_total", "counter", "Обращения к кэшам")
+def collect_caches():
+    caches = {**amo_client.cache_stats(), "dedup": dedup.stats()}
+    for cache, stats in caches.items():
+        for result in ("hits", "misses"):
+            labels = {"cache": cache, "result": result}
+            yield "cache_requests_total", labels, stats[result]
 
 
 # Запуск приложения
 if __name__ == "__main__":
     import uvicorn
 
-    uvicorn.run(app, host="0.0.0.0", port=8010)
+    if WEB_WORKERS > 1:
+        uvicorn.run("main:app", host="0.0.0.0", port=8010, workers=WEB_WORKERS)
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=8010)
@@ -0,0 +1,158 @@
+"""Метрики в текстовом формате Prometheus.
+
+Счетчики и гистограммы хранятся в обычных словарях и обновляются без
+блокировок (все обновления идут из цикла событий), поэтому их можно
+вызывать на горячем пути. Значения, которые уже считаются в других
+объектах (размеры очередей, статусы ответов AmoCRM), не дублируются:
+они снимаются функциями-сборщиками в момент запроса `/metrics`.
+"""
+
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple
+
+Labels = Tuple[str, ...]
+Sample = Tuple[str, Dict[str, str], float]
+Collector = Tuple[str, str, str, Callable[[], Iterable[Sample]]]
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return (
+        "{"
+        + ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items())
+        + "}"
+    )
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Labels, float] = {}
+
+    def inc(self, *labelvalues: str, value: float = 1):
+        self._values[labelvalues] = self._values.get(labelvalues, 0) + value
+
+    def samples(self) -> Iterable[Sample]:
+        for labelvalues, value in self._values.items():
+            yield self.name, dict(zip(self.labelnames, labelvalues)), value
+
+
+class Histogram:
+    type = "histogram"
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # Для каждого набора меток: [счетчики корзин..., +Inf, сумма]
+        self._values: Dict[Labels, List[float]] = {}
+
+    def observe(self, value: float, *labelvalues: str):
+        row = self._values.get(labelvalues)
+        if row is None:
+            row = self._values[labelvalues] = [0] * (len(self.buckets) + 2)
+        row[bisect_left(self.buckets, value)] += 1
+        row[-1] += value
+
+    def samples(self) -> Iterable[Sample]:
+        for labelvalues, row in self._values.items():
+            labels = dict(zip(self.labelnames, labelvalues))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), row):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                yield f"{self.name}_bucket", {**labels, "le": le}, cumulative
+            yield f"{self.name}_count", labels, cumulative
+            yield f"{self.name}_sum", labels, row[-1]
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: List = []
+        self._collectors: List[Collector] = []
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+        metric = Counter(name, help, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(
+        self, name: str, help: str, labelnames: Sequence[str] = (), **kwargs
+    ) -> Histogram:
+        metric = Histogram(name, help, labelnames, **kwargs)
+        self._metrics.append(metric)
+        return metric
+
+    def collector(self, name: str, type: str, help: str):
+        """Декоратор функции, которая отдает значения метрики при запросе `/metrics`"""
+
+        def register(func: Callable[[], Iterable[Sample]]):
+            self._collectors.append((name, type, help, func))
+            return func
+
+        return register
+
+    def render(self) -> str:
+        lines = []
+        families = [(m.name, m.type, m.help, m.samples) for m in self._metrics]
+        for name, type, help, samples in families + self._collectors:
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {type}")
+            for sample_name, labels, value in samples():
+                lines.append(f"{sample_name}{_format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+REQUESTS = REGISTRY.counter(
+    "http_requests_total", "HTTP-запросы к приложению", ("path", "status")
+)
+STAGE_SECONDS = REGISTRY.histogram(
+    "lead_stage_seconds", "Время этапов обработки сделки", ("stage",)
+)
+ERRORS = REGISTRY.counter(
+    "lead_errors_total", "Ошибки обработки сделок по типу исключения", ("type",)
+)
+
+
+class MetricsMiddleware:
+    """ASGI-прослойка, считающая HTTP-запросы по маршруту и статусу ответа"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # Путь маршрута, а не URL, чтобы не плодить метки
+            route = scope.get("route")
+            REQUESTS.inc(getattr(route, "path", "other"), str(status))
@@ -0,0 +1,232 @@
+import asyncio
+import time
+from contextlib import contextmanager
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+from loguru import logger
+from metrics import ERRORS, STAGE_SECONDS
+
+
+class StageStats:
+    """Статистика времени выполнения одного этапа обработки"""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, elapsed: float):
+        self.count += 1
+        self.total += elapsed
+        if elapsed > self.max:
+            self.max = elapsed
+
+    def as_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "avg_ms": round(self.total / self.count * 1000, 2) if self.count else 0.0,
+            "max_ms": round(self.max * 1000, 2),
+        }
+
+
+class LeadPipeline:
+    """Фоновая обработка сделок пулом воркеров.
+
+    Вебхук только кладет `id` задания в очередь и сразу отвечает, а сама
+    обработка (`handler`) выполняется `workers` фоновыми задачами.
+
+    Ожидание пакетной отправки (`defer`) не занимает воркер: строки таблицы
+    копятся до `flush_interval` секунд, и если бы воркеры ждали записи,
+    пачка никогда не была бы больше числа воркеров.
+
+    Задание, завершившееся ошибкой, повторяется до `max_attempts` раз с
+    растущей задержкой от `retry_delay` секунд; после последней попытки
+    вызывается `on_failure`.
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[int], Awaitable[None]],
+        workers: int = 4,
+        max_queue: int = 1000,
+        max_attempts: int = 3,
+        retry_delay: float = 5.0,
+        on_failure: Optional[Callable[[int], Awaitable[None]]] = None,
+    ):
+        self.handler = handler
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.on_failure = on_failure
+        self._attempts: Dict[int, int] = {}
+        # Задания, обработка которых продолжается в `defer`: их счетчик
+        # попыток сбрасывается только после успешного завершения
+        self._deferred_jobs: Set[int] = set()
+        self._retries: Set[asyncio.Task] = set()
+        self._queue: asyncio.Queue[int] = asyncio.Queue(maxsize=max_queue)
+        self._tasks: List[asyncio.Task] = []
+        self._deferred: Set[asyncio.Task] = set()
+        self._stages: Dict[str, StageStats] = {}
+        self._busy = 0
+        self._busy_time = 0.0
+        self._started_at: Optional[float] = None
+        self.processed = 0
+        self.failed = 0
+        self.retried = 0
+        self.counters: Dict[str, int] = {}
+
+    def start(self):
+        """Запуск воркеров"""
+        if self._tasks:
+            return
+        self._started_at = time.monotonic()
+        self._tasks = [
+            asyncio.create_task(self._worker(i)) for i in range(self.workers)
+        ]
+        logger.info(f"Обработка сделок запущена, воркеров: {self.workers}")
+
+    async def stop(self):
+        """Остановка воркеров после обработки уже принятых сделок"""
+        if not self._tasks:
+            return
+        await self._queue.join()
+        # Отложенные повторы не ждем: задания остались незавершенными в
+        # очереди на диске и будут восстановлены при запуске
+        for task in [*self._tasks, *self._retries]:
+            task.cancel()
+        await asyncio.gather(*self._retries, return_exceptions=True)
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        # Отложенные этапы завершатся с ближайшей отправкой пачек
+        await asyncio.gather(*self._deferred, return_exceptions=True)
+        logger.info("Обработка сделок остановлена.")
+
+    async def submit(self, job_id: int):
+        """Ставит задание в очередь на обработку"""
+        await self._queue.put(job_id)
+
+    def defer(self, job_id: int, awaitable: Awaitable[None]):
+        """Дожидается завершения обработки задания вне воркера"""
+        self._deferred_jobs.add(job_id)
+        task = asyncio.ensure_future(self._finish(job_id, awaitable))
+        self._deferred.add(task)
+        task.add_done_callback(self._deferred.discard)
+
+    async def _finish(self, job_id: int, awaitable: Awaitable[None]):
+        try:
+            await awaitable
+        except Exception as e:
+            ERRORS.inc(type(e).__name__)
+            logger.error(f"Ошибка при завершении задания #{job_id}: {e}")
+            self._failed(job_id)
+        else:
+            self._attempts.pop(job_id, None)
+        finally:
+            self._deferred_jobs.discard(job_id)
+
+    def count(self, name: str, value: int = 1):
+        """Увеличивает именованный счетчик"""
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    @contextmanager
+    def stage(self, name: str):
+        """Замеряет время выполнения этапа обработки"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            self._stages.setdefault(name, StageStats()).observe(elapsed)
+            STAGE_SECONDS.observe(elapsed, name)
+
+    async def timed(self, name: str, awaitable: Awaitable[Any]) -> Any:
+        """Ожидает `awaitable`, замеряя время как этап `name`"""
+        with self.stage(name):
+            return await awaitable
+
+    async def _worker(self, number: int):
+        while True:
+            job_id = await self._queue.get()
+            self._busy += 1
+            started = time.monotonic()
+            try:
+                with self.stage("total"):
+                    await self.handler(job_id)
+                self.processed += 1
+                if job_id not in self._deferred_jobs:
+                    self._attempts.pop(job_id, None)
+            except Exception as e:
+                ERRORS.inc(type(e).__name__)
+                logger.error(
+                    f"Воркер {number}: ошибка при обработке задания #{job_id}: {e}"
+                )
+                self._failed(job_id)
+            finally:
+                self._busy -= 1
+                self._busy_time += time.monotonic() - started
+                self._queue.task_done()
+
+    def _failed(self, job_id: int):
+        attempts = self._attempts.get(job_id, 0) + 1
+        if attempts < self.max_attempts:
+            self._attempts[job_id] = attempts
+            self.retried += 1
+            task = asyncio.create_task(
+                self._retry(job_id, self.retry_delay * 2 ** (attempts - 1))
+            )
+            self._retries.add(task)
+            task.add_done_callback(self._retries.discard)
+            return
+        self._attempts.pop(job_id, None)
+        self.failed += 1
+        if self.on_failure is not None:
+            task = asyncio.create_task(self.on_failure(job_id))
+            self._deferred.add(task)
+            task.add_done_callback(self._deferred.discard)
+
+    async def _retry(self, job_id: int, delay: float):
+        await asyncio.sleep(delay)
+        logger.info(f"Повторная обработка задания #{job_id}")
+        await self.submit(job_id)
+
+    def stats(self) -> dict:
+        """Состояние очереди, загрузка воркеров и время этапов"""
+        uptime = time.monotonic() - self._started_at if self._started_at else 0.0
+        return {
+            "queue_size": self._queue.qsize(),
+            "workers": self.workers,
+            "busy_workers": self._busy,
+            "deferred": len(self._deferred),
+            "utilization": (
+                round(self._busy_time / (uptime * self.workers), 4) if uptime else 0.0
+            ),
+            "processed": self.processed,
+            "failed": self.failed,
+            "retried": self.retried,
+            "counters": dict(self.counters),
+            "stages": {name: s.as_dict() for name, s in self._stages.items()},
+        }
+
+
+async def gather_partial(
+    awaitables: Dict[str, Awaitable[Any]], timeout: float
+) -> Dict[str, Any]:
+    """Выполняет независимые запросы одновременно с общим ограничением времени.
+
+    Возвращает результаты только успешно завершившихся запросов: упавшие и не
+    уложившиеся в `timeout` пропускаются с предупреждением в логе.
+    """
+    if not awaitables:
+        return {}
+    tasks = {name: asyncio.ensure_future(aw) for name, aw in awaitables.items()}
+    done, pending = await asyncio.wait(tasks.values(), timeout=timeout)
+    for task in pending:
+        task.cancel()
+    results = {}
+    for name, task in tasks.items():
+        if task in pending:
+            logger.warning(f"Запрос `{name}` не уложился в {timeout} с")
+        elif task.exception() is not None:
+            logger.warning(f"Запрос `{name}` завершился ошибкой: {task.exception()}")
+        else:
+            results[name] = task.result()
+    return results
@@ -0,0 +1,163 @@
+"""Загрузка смен статусов сделок из событий AmoCRM.
+
+Режим приема сделок без вебхука (или страховка к нему): раз в `interval`
+секунд запрашиваются события `lead_status_changed`, созданные после курсора,
+и переходы сделок передаются в `handle` пачкой, в порядке создания событий.
+
+Курсор — время последнего обработанного события и `id` событий с этим
+временем (границы фильтра включительные). Он сохраняется только после
+успешной обработки, поэтому после простоя или ошибки загрузка продолжается с
+того же места. События последних `settle_delay` секунд откладываются до
+следующего цикла: AmoCRM может записать их с небольшой задержкой.
+"""
+
+import asyncio
+import json
+import os
+import time
+from typing import Awaitable, Callable, List, Optional
+from loguru import logger
+from amocrm import AmoCRMClient
+from coordination import Coordinator
+
+EVENT_TYPES = ("lead_status_changed",)
+
+
+class EventCursor:
+    """Курсор событий: файл JSON или общее состояние воркеров"""
+
+    KEY = "events_cursor"
+
+    def __init__(self, path: str, coordinator: Optional[Coordinator] = None):
+        self.path = path
+        self.coordinator = coordinator
+
+    async def load(self) -> Optional[dict]:
+        if self.coordinator is not None:
+            state = await self.coordinator.get(self.KEY)
+            return json.loads(state) if state else None
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path, encoding="utf-8") as f:
+            return json.load(f)
+
+    async def save(self, state: dict):
+        if self.coordinator is not None:
+            await self.coordinator.set(self.KEY, json.dumps(state))
+            return
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.path)
+
+
+def lead_status(event: dict) -> Optional[dict]:
+    """Переход сделки из события в том же виде, что `leads[status][N]` вебхука"""
+    if event.get("entity_type") != "lead":
+        return None
+    for value in event.get("value_after") or []:
+        status = value.get("lead_status")
+        if status:
+            return {
+                "id": str(event["entity_id"]),
+                "status_id": str(status["id"]),
+                "pipeline_id": str(status["pipeline_id"]),
+            }
+    return None
+
+
+class EventPoller:
+    """Периодический опрос `/api/v4/events`.
+
+    При нескольких воркерах в каждом интервале опрашивает только тот, кто
+    первым займет ключ в общем состоянии; курсор тоже хранится там.
+    """
+
+    def __init__(
+        self,
+        client: AmoCRMClient,
+        handle: Callable[[List[dict]], Awaitable[None]],
+        interval: float = 30.0,
+        cursor_path: str = "events_cursor.json",
+        settle_delay: int = 10,
+        coordinator: Optional[Coordinator] = None,
+    ):
+        self.client = client
+        self.handle = handle
+        self.interval = interval
+        self.settle_delay = settle_delay
+        self.coordinator = coordinator
+        self.cursor = EventCursor(cursor_path, coordinator)
+        self._task: Optional[asyncio.Task] = None
+        self.polls = 0
+        self.events = 0
+        self.errors = 0
+        self.lag: Optional[float] = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+            logger.info(f"Опрос событий AmoCRM запущен, интервал {self.interval} с")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                if self.coordinator is None:
+                    await self.poll()
+                elif await self.coordinator.claim("events_poller", self.interval):
+                    async with self.coordinator.lock("events_cursor", ttl=600):
+                        await self.poll()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.errors += 1
+                logger.error(f"Ошибка при опросе событий AmoCRM: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def poll(self) -> int:
+        """Один цикл опроса; возвращает количество новых событий"""
+        self.polls += 1
+        until = int(time.time()) - self.settle_delay
+        state = await self.cursor.load()
+        if state is None:
+            # Первый запуск: история не загружается (для нее есть backfill.py)
+            await self.cursor.save({"created_at": until, "ids": []})
+            logger.info("Курсор событий AmoCRM создан")
+            return 0
+        since, seen = state["created_at"], set(state["ids"])
+        if until < since:
+            return 0
+        events = []
+        async for page in self.client.iter_events(EVENT_TYPES, since, until):
+            events.extend(event for event in page if event["id"] not in seen)
+        self.lag = time.time() - since
+        if not events:
+            return 0
+        events.sort(key=lambda event: (event["created_at"], event["id"]))
+        statuses = [status for status in map(lead_status, events) if status]
+        logger.info(
+            f"События AmoCRM: {len(events)}, переходов сделок: {len(statuses)}"
+        )
+        if statuses:
+            await self.handle(statuses)
+        last = events[-1]["created_at"]
+        ids = [event["id"] for event in events if event["created_at"] == last]
+        if last == since:
+            ids.extend(seen)
+        await self.cursor.save({"created_at": last, "ids": ids})
+        self.events += len(events)
+        return len(events)
+
+    def stats(self) -> dict:
+        return {
+            "polls": self.polls,
+            "events": self.events,
+            "errors": self.errors,
+            "lag_s": round(self.lag, 1) if self.lag is not None else None,
+        }
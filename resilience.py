@@ -0,0 +1,303 @@
+"""Предохранители и отложенная доставка для Telegram и Google Таблицы.
+
+Если внешний сервис недоступен, каждая сделка ждала бы его таймаута, а
+данные терялись бы после исчерпания повторов. Вместо этого:
+
+- `CircuitBreaker` после `failure_threshold` ошибок сервиса подряд
+  размыкается и `reset_timeout` секунд сразу отклоняет вызовы
+  (`CircuitOpenError`), затем пропускает один пробный вызов. Ошибки в данных
+  (все, кроме `transient`) предохранитель не считает;
+- `DeadLetterStore` хранит в SQLite то, что не удалось доставить (строку
+  таблицы или текст сообщения), вместе с ошибкой;
+- `Redriver` повторно отправляет отложенное пачками: сразу после замыкания
+  предохранителя и раз в `interval` секунд. Письмо, не доставленное за
+  `max_attempts` попыток, откладывается в сторону и больше не отправляется.
+"""
+
+import asyncio
+import inspect
+import json
+import sqlite3
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+import aiohttp
+from loguru import logger
+
+# Ошибки, говорящие о недоступности сервиса, а не о неверных данных
+TRANSIENT_ERRORS: Tuple[type, ...] = (
+    aiohttp.ClientError,
+    asyncio.TimeoutError,
+    ConnectionError,
+    TimeoutError,
+)
+
+
+class CircuitOpenError(Exception):
+    """Вызов отклонен: предохранитель разомкнут"""
+
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30.0,
+        transient: Tuple[type, ...] = TRANSIENT_ERRORS,
+    ):
+        self.name = name
+        self.transient = transient
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.rejected = 0
+        self._opened_at: Optional[float] = None
+        self._trial = False  # Пробный вызов в полуоткрытом состоянии уже идет
+        # Устанавливается при замыкании: по нему запускается повторная отправка
+        self.closed = asyncio.Event()
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return self.CLOSED
+        if time.monotonic() - self._opened_at >= self.reset_timeout:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    def allows(self) -> bool:
+        state = self.state
+        return state == self.CLOSED or (state == self.HALF_OPEN and not self._trial)
+
+    async def call(self, awaitable: Awaitable) -> Any:
+        """Выполняет вызов через предохранитель"""
+        if not self.allows():
+            self.rejected += 1
+            if inspect.iscoroutine(awaitable):
+                awaitable.close()  # Корутина так и не будет запущена
+            raise CircuitOpenError(f"{self.name}: сервис недоступен")
+        trial = self.state == self.HALF_OPEN
+        if trial:
+            self._trial = True
+        try:
+            result = await awaitable
+        except self.transient:
+            self._on_failure()
+            raise
+        finally:
+            if trial:
+                self._trial = False
+        self._on_success()
+        return result
+
+    def _on_failure(self):
+        self.failures += 1
+        if self._opened_at is not None or self.failures >= self.failure_threshold:
+            if self._opened_at is None:
+                logger.warning(f"Предохранитель {self.name} разомкнут")
+            self._opened_at = time.monotonic()
+
+    def _on_success(self):
+        if self._opened_at is not None:
+            logger.info(f"Предохранитель {self.name} замкнут")
+            self._opened_at = None
+            self.closed.set()
+        self.failures = 0
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "rejected": self.rejected,
+        }
+
+
+class DeadLetterStore:
+    """Недоставленные данные по получателям (`sink`), хранящиеся в SQLite"""
+
+    def __init__(self, path: str = "dead_letters.db"):
+        self.path = path
+        self._conn = sqlite3.connect(path, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS dead_letters (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                job_id INTEGER,
+                sink TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                error TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL,
+                parked INTEGER NOT NULL DEFAULT 0
+            )
+            """
+        )
+        columns = {
+            row["name"]
+            for row in self._conn.execute("PRAGMA table_info(dead_letters)")
+        }
+        if "parked" not in columns:
+            # Колонка появилась позже: добавляем в уже существующую базу
+            self._conn.execute(
+                "ALTER TABLE dead_letters ADD COLUMN parked INTEGER NOT NULL DEFAULT 0"
+            )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS dead_letters_sink ON dead_letters (sink, id)"
+        )
+        logger.info(f"Хранилище недоставленных открыто: {path}")
+
+    def add(
+        self, sink: str, payload: Any, error: str, job_id: Optional[int] = None
+    ) -> int:
+        """Сохраняет недоставленное и возвращает его `id`"""
+        cursor = self._conn.execute(
+            "INSERT INTO dead_letters (job_id, sink, payload, error, created_at) VALUES (?, ?, ?, ?, ?)",
+            (
+                job_id,
+                sink,
+                json.dumps(payload, ensure_ascii=False, default=str),
+                error,
+                time.time(),
+            ),
+        )
+        return cursor.lastrowid
+
+    def batch(self, sink: str, limit: int = 100) -> List[sqlite3.Row]:
+        """Самые старые недоставленные для получателя (кроме отложенных)"""
+        return self._conn.execute(
+            "SELECT * FROM dead_letters WHERE sink = ? AND parked = 0 ORDER BY id LIMIT ?",
+            (sink, limit),
+        ).fetchall()
+
+    def remove(self, letter_id: int):
+        self._conn.execute("DELETE FROM dead_letters WHERE id = ?", (letter_id,))
+
+    def failed(self, letter_id: int, error: str, max_attempts: int) -> bool:
+        """Отмечает неудачную попытку; True — письмо отложено в сторону"""
+        self._conn.execute(
+            "UPDATE dead_letters SET attempts = attempts + 1, error = ?, "
+            "parked = attempts + 1 >= ? WHERE id = ?",
+            (error, max_attempts, letter_id),
+        )
+        (parked,) = self._conn.execute(
+            "SELECT parked FROM dead_letters WHERE id = ?", (letter_id,)
+        ).fetchone()
+        return bool(parked)
+
+    def counts(self, parked: bool = False) -> Dict[str, int]:
+        """Количество недоставленных (или отложенных) по получателям"""
+        return dict(
+            self._conn.execute(
+                "SELECT sink, COUNT(*) FROM dead_letters WHERE parked = ? GROUP BY sink",
+                (int(parked),),
+            ).fetchall()
+        )
+
+    def close(self):
+        self._conn.close()
+
+
+class Redriver:
+    """Повторная отправка недоставленного через предохранители получателей.
+
+    Письма пачки сначала отправляются по одному как проба, пока одно не
+    будет доставлено: если получатель все еще недоступен, предохранитель
+    размыкается и остальные не трогаются, а письмо с ошибкой в данных не
+    задерживает письма за ним. После успешной пробы остальные отправляются
+    одновременно — очереди Telegram и таблицы сами объединяют их в пакеты.
+    """
+
+    def __init__(
+        self,
+        store: DeadLetterStore,
+        breakers: Dict[str, CircuitBreaker],
+        senders: Dict[str, Callable[[Any], Awaitable]],
+        interval: float = 30.0,
+        batch_size: int = 100,
+        max_attempts: int = 10,
+        coordinator=None,
+    ):
+        self.store = store
+        # При нескольких воркерах пачку отправляет один из них
+        self.coordinator = coordinator
+        self.breakers = breakers
+        self.senders = senders
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.redriven = 0
+        self.parked = 0
+        self._tasks: List[asyncio.Task] = []
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [
+                asyncio.create_task(self._run(sink)) for sink in self.senders
+            ]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _run(self, sink: str):
+        closed = self.breakers[sink].closed
+        while True:
+            try:
+                await asyncio.wait_for(closed.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            closed.clear()
+            try:
+                # Отправляем пачки, пока они есть и получатель доступен
+                if self.coordinator is None:
+                    while await self.redrive(sink):
+                        pass
+                else:
+                    async with self.coordinator.lock(f"redrive:{sink}", ttl=300):
+                        while await self.redrive(sink):
+                            pass
+            except Exception as e:
+                logger.error(f"Ошибка повторной отправки ({sink}): {e}")
+
+    async def redrive(self, sink: str) -> int:
+        """Одна пачка; возвращает количество доставленных"""
+        if not self.breakers[sink].allows():
+            return 0
+        letters = self.store.batch(sink, self.batch_size)
+        for i, letter in enumerate(letters):
+            if not self.breakers[sink].allows():
+                return 0
+            if await self._send(sink, letter):
+                break
+        else:
+            return 0
+        results = await asyncio.gather(
+            *(self._send(sink, letter) for letter in letters[i + 1 :])
+        )
+        delivered = 1 + sum(results)
+        self.redriven += delivered
+        logger.info(f"Повторно доставлено ({sink}): {delivered} из {len(letters)}")
+        return delivered
+
+    async def _send(self, sink: str, letter: sqlite3.Row) -> bool:
+        try:
+            await self.breakers[sink].call(
+                self.senders[sink](json.loads(letter["payload"]))
+            )
+        except Exception as e:
+            if self.store.failed(letter["id"], str(e), self.max_attempts):
+                self.parked += 1
+                logger.warning(
+                    f"Письмо #{letter['id']} ({sink}) отложено после "
+                    f"{self.max_attempts} попыток: {e}"
+                )
+            return False
+        self.store.remove(letter["id"])
+        return True
@@ -0,0 +1,137 @@
+"""Локальная копия ключевых колонок Google Таблицы.
+
+Чтобы узнать номер следующей свободной строки или проверить, записана ли
+сделка, раньше приходилось скачивать весь лист (`get_all_values`). Копия в
+SQLite хранит для каждой строки `id` сделки, телефон и дату оплаты с
+индексами по ним. Строки, записанные приложением, добавляются в копию сразу
+после записи, а строки, добавленные кем-то еще, догружаются чтением только
+новых строк ниже уже известных (`GoogleSheets.sync`).
+"""
+
+import sqlite3
+import threading
+from typing import Iterable, List, Optional, Sequence, Set, Tuple
+from loguru import logger
+from amocrm.models import SHEET_COLUMNS
+
+_COLUMN_INDEX = {name: i + 1 for i, (name, _) in enumerate(SHEET_COLUMNS)}
+# Номера колонок листа (с 1)
+FIRST_COLUMN = 1
+ID_COLUMN = _COLUMN_INDEX["ID сделки"]
+PHONE_COLUMN = _COLUMN_INDEX["Телефон"]
+PAYMENT_DATE_COLUMN = _COLUMN_INDEX["Дата оплаты"]
+MIRROR_COLUMNS = (FIRST_COLUMN, ID_COLUMN, PHONE_COLUMN, PAYMENT_DATE_COLUMN)
+
+Keys = Tuple[str, str, str]  # id сделки, телефон, дата оплаты
+
+
+def row_keys(row: Sequence) -> Keys:
+    """Ключи строки в порядке `SHEET_COLUMNS`"""
+
+    def cell(column: int) -> str:
+        return str(row[column - 1]) if len(row) >= column else ""
+
+    return cell(ID_COLUMN), cell(PHONE_COLUMN), cell(PAYMENT_DATE_COLUMN)
+
+
+class SheetMirror:
+    """Ключи строк листов таблицы в SQLite, по строке на строку листа"""
+
+    def __init__(self, path: str = "sheet_mirror.db"):
+        self.path = path
+        # Используется из цикла событий и из потока записи в таблицу
+        self._conn = sqlite3.connect(
+            path, isolation_level=None, check_same_thread=False
+        )
+        self._lock = threading.RLock()
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS sheet_rows (
+                sheet TEXT NOT NULL,
+                row INTEGER NOT NULL,
+                lead_id TEXT,
+                phone TEXT,
+                payment_date TEXT,
+                PRIMARY KEY (sheet, row)
+            )
+            """
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS sheet_rows_lead ON sheet_rows (lead_id)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS sheet_rows_phone ON sheet_rows (phone, payment_date)"
+        )
+        logger.info(f"Копия таблицы открыта: {path}")
+
+    def row_count(self, sheet: str) -> int:
+        """Номер последней известной заполненной строки листа"""
+        (count,) = self._conn.execute(
+            "SELECT COALESCE(MAX(row), 0) FROM sheet_rows WHERE sheet = ?", (sheet,)
+        ).fetchone()
+        return count
+
+    def append(self, sheet: str, start_row: int, keys: Iterable[Keys]):
+        """Записывает ключи строк, начиная со строки `start_row`"""
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO sheet_rows (sheet, row, lead_id, phone, payment_date) VALUES (?, ?, ?, ?, ?)",
+                [(sheet, start_row + i, *key) for i, key in enumerate(keys)],
+            )
+
+    def insert(self, sheet: str, index: int, keys: List[Keys]):
+        """Вставка строк на позицию `index` со сдвигом нижних строк, как в листе"""
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                # Сдвиг через отрицательные номера, чтобы не нарушить первичный ключ
+                self._conn.execute(
+                    "UPDATE sheet_rows SET row = -(row + ?) WHERE sheet = ? AND row >= ?",
+                    (len(keys), sheet, index),
+                )
+                self._conn.execute(
+                    "UPDATE sheet_rows SET row = -row WHERE sheet = ? AND row < 0",
+                    (sheet,),
+                )
+                self.append(sheet, index, keys)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def reset(self, sheet: str):
+        """Забывает лист: при следующей сверке он будет прочитан целиком"""
+        with self._lock:
+            self._conn.execute("DELETE FROM sheet_rows WHERE sheet = ?", (sheet,))
+
+    def has_lead(self, lead_id, sheet: Optional[str] = None) -> bool:
+        query = "SELECT 1 FROM sheet_rows WHERE lead_id = ?"
+        params = [str(lead_id)]
+        if sheet is not None:
+            query += " AND sheet = ?"
+            params.append(sheet)
+        return self._conn.execute(query + " LIMIT 1", params).fetchone() is not None
+
+    def find(self, phone: str, payment_date: str) -> List[Tuple[str, int]]:
+        """Строки (лист, номер) с заданными телефоном и датой оплаты"""
+        return self._conn.execute(
+            "SELECT sheet, row FROM sheet_rows WHERE phone = ? AND payment_date = ?",
+            (str(phone), str(payment_date)),
+        ).fetchall()
+
+    def existing_keys(self) -> Tuple[Set[str], Set[Tuple[str, str]]]:
+        """`id` записанных сделок и (телефон, дата оплаты) строк без `id`"""
+        lead_ids, pairs = set(), set()
+        for lead_id, phone, date in self._conn.execute(
+            "SELECT lead_id, phone, payment_date FROM sheet_rows"
+        ):
+            if lead_id:
+                lead_ids.add(lead_id)
+            elif phone or date:
+                pairs.add((phone, date))
+        return lead_ids, pairs
+
+    def close(self):
+        self._conn.close()
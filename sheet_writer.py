@@ -0,0 +1,188 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+from loguru import logger
+from google_sheets import GoogleSheets
+from coordination import Coordinator
+
+# Ключи общего состояния при нескольких воркерах
+SHARED_LOCK = "sheet_rows"
+SHARED_NEXT_ROW = "sheet_next_row"
+
+
+class SheetWriter:
+    """Буферизованная запись строк в Google Таблицу.
+
+    Номер следующей свободной строки хранится локально (для каждого листа) и
+    сверяется с таблицей не чаще раза в `reconcile_interval` секунд (а также
+    после ошибки записи). Строки копятся `flush_interval` секунд или до
+    `max_batch` штук, раскладываются по листам (`GoogleSheets.route`) и
+    записываются одним запросом на лист.
+
+    Если задан `coordinator`, номер строки хранится в общем состоянии
+    процессов, а запись пачки выполняется под общей блокировкой: вставки
+    разных воркеров не перемежаются и не оставляют пропусков.
+
+    Блокирующие вызовы gspread выполняются в отдельном потоке, чтобы не
+    останавливать цикл событий. Очередь ограничена `max_queue` строками:
+    когда она заполнена, `write` ждет освобождения места.
+    """
+
+    def __init__(
+        self,
+        sheets: GoogleSheets,
+        flush_interval: float = 2.0,
+        max_batch: int = 100,
+        reconcile_interval: float = 600.0,
+        max_queue: int = 1000,
+        coordinator: Optional[Coordinator] = None,
+    ):
+        self.sheets = sheets
+        self.coordinator = coordinator
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.reconcile_interval = reconcile_interval
+        # None в очереди — сигнал остановки
+        self._queue: asyncio.Queue[Optional[Tuple[list, asyncio.Future]]]
+        self._queue = asyncio.Queue(maxsize=max_queue)
+        # Один поток: строки должны записываться строго по очереди
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="sheet-writer"
+        )
+        self._next_rows: Dict[str, int] = {}
+        self._reconciled_at: Dict[str, float] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        """Запуск фоновой задачи записи"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+            logger.info("Запись в Google Таблицу запущена.")
+
+    async def stop(self):
+        """Остановка фоновой задачи с записью оставшихся строк"""
+        if self._task:
+            await self._queue.put(None)  # Сигнал остановки после всех строк
+            await self._task
+            self._task = None
+        self._executor.shutdown(wait=False)
+        logger.info("Запись в Google Таблицу остановлена.")
+
+    @property
+    def queue_size(self) -> int:
+        """Количество строк, ожидающих записи"""
+        return self._queue.qsize()
+
+    async def write(self, row_data: list):
+        """Ставит строку в очередь и ждет, пока она будет записана в таблицу.
+
+        Строка подготавливается до постановки в очередь: ошибка в данных одной
+        сделки достается только ее вызову, а не всей пачке.
+        """
+        row_data = self.sheets.prepare_row(row_data)
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((row_data, future))
+        await future
+
+    async def _run(self):
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._flush(batch)
+
+    async def _flush(self, batch: List[Tuple[list, asyncio.Future]]):
+        """Записывает пачку строк: один запрос на каждый лист в потоке записи."""
+        if not batch:
+            return
+        rows = [row_data for row_data, _ in batch]
+        loop = asyncio.get_running_loop()
+        try:
+            groups = await loop.run_in_executor(
+                self._executor, self.sheets.route, rows
+            )
+        except Exception as e:
+            groups = {}
+            self._resolve(batch, e)
+        for title, indices in groups.items():
+            group = [rows[i] for i in indices]
+            try:
+                if self.coordinator is None:
+                    await self._write_in_thread(title, group)
+                else:
+                    await self._write_shared(title, group)
+            except Exception as e:
+                self._resolve([batch[i] for i in indices], e)
+            else:
+                self._resolve([batch[i] for i in indices])
+
+    @staticmethod
+    def _resolve(items: List[Tuple[list, asyncio.Future]], error=None):
+        for _, future in items:
+            if future.done():
+                continue
+            if error is None:
+                future.set_result(None)
+            else:
+                future.set_exception(error)
+
+    async def _write_in_thread(self, title: str, rows: List[list]):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self._write_batch, title, rows)
+
+    async def _write_shared(self, title: str, rows: List[list]):
+        """Запись под общей блокировкой с номером строки из общего состояния"""
+        key = f"{SHARED_NEXT_ROW}:{title}"
+        async with self.coordinator.lock(f"{SHARED_LOCK}:{title}", ttl=120):
+            value = await self.coordinator.get(key)
+            if value:
+                self._next_rows[title] = int(value)
+            else:
+                self._next_rows.pop(title, None)
+            try:
+                await self._write_in_thread(title, rows)
+            finally:
+                if title in self._next_rows:
+                    await self.coordinator.set(key, str(self._next_rows[title]))
+                else:
+                    await self.coordinator.delete(key)
+
+    def _write_batch(self, title: str, rows: List[list]):
+        if (
+            title not in self._next_rows
+            or time.monotonic() - self._reconciled_at.get(title, 0.0)
+            > self.reconcile_interval
+        ):
+            self.reconcile(title)
+        try:
+            self.sheets.insert_rows(rows, self._next_rows[title], sheet=title)
+        except Exception:
+            # Позиция могла разойтись с таблицей — сверимся при следующей записи
+            self._next_rows.pop(title, None)
+            raise
+        self._next_rows[title] += len(rows)
+
+    def reconcile(self, title: Optional[str] = None):
+        """Сверяет локальный номер свободной строки листа с таблицей."""
+        title = title or self.sheets.worksheet.title
+        self._next_rows[title] = (
+            self.sheets.get_filled_row_count(title, verify=True) + 1
+        )
+        self._reconciled_at[title] = time.monotonic()
+        logger.info(f"Следующая свободная строка ({title}): {self._next_rows[title]}")
@@ -0,0 +1,183 @@
+import asyncio
+from html import escape
+from typing import Dict, Optional, Tuple
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter
+from loguru import logger
+from amocrm.models import Lead
+from amocrm.rate_limit import TokenBucket
+
+
+# Шаблон сообщения о новом ученике, значения берутся из `Lead.telegram_payload`
+TELEGRAM_TEMPLATE = (
+    "<u>Примите нового ученика</u>.😊\n"
+    "Дата оплаты: <b>{payment_date}</b>\n\n"
+    "🤓Ученик: <b>{learner_last_name} {learner_first_name}</b>\n"
+    "✔️Класс и отделение: <b>{grade} {departament}</b>\n"
+    "⏰Время: <b>{learning_time}</b>\n"
+    "👩‍👦 Родитель: <b>{parent_name}</b>\n"
+    "📞 Телефон: <b>{parent_phone}</b>\n"
+    "🏠 Филиал: <b>{branch}</b>\n\n"
+    "🔷 Срок обучения: <b>{learning_duration}</b>\n\n"
+    "🟢 Дата начала обучения: <b>{start_date}</b>\n"
+    "🔴 Дата конца обучения: <b>{end_date}</b>\n\n"
+    "🎯Направление обучения: <b>{learning_direction}</b>\n"
+    "📚Профильные предметы: <b>{profile_subjects}</b>\n"
+    "ℹ️Новый или продление: <b>{status}</b>\n"
+    "📨Комментарий ОП: <b>{manager_comment}</b>\n\n"
+    "😎Менеджер: <b>{manager_name}</b>"
+)
+_render = TELEGRAM_TEMPLATE.format
+
+# Разделитель сообщений, объединенных в одно при заполненной очереди
+COALESCE_SEPARATOR = "\n\n➖➖➖➖➖\n\n"
+# Максимальная длина сообщения в Telegram
+MESSAGE_LIMIT = 4096
+
+
+def render_lead(lead: Lead) -> str:
+    """Текст сообщения о сделке; значения экранируются для HTML"""
+    return _render(
+        **{
+            name: escape(str(value), quote=False)
+            for name, value in lead.telegram_payload().items()
+        }
+    )
+
+
+class TelegramDispatcher:
+    """Очередь отправки сообщений в Telegram с ограничением частоты.
+
+    Для каждого чата своя очередь и свое «ведро с токенами» (в группу можно
+    отправлять около 20 сообщений в минуту). Ответ `RetryAfter` приостанавливает
+    отправку в чат на указанное время. Если в очереди набралось не меньше
+    `coalesce_threshold` сообщений, они объединяются в одно.
+    """
+
+    def __init__(
+        self,
+        bot: Optional[Bot],
+        rate_per_minute: float = 20,
+        burst: float = 3,
+        coalesce_threshold: int = 5,
+        max_attempts: int = 5,
+        coordinator=None,
+    ):
+        self.bot = bot
+        self.rate = rate_per_minute / 60
+        self.burst = burst
+        self.coalesce_threshold = coalesce_threshold
+        self.max_attempts = max_attempts
+        # При нескольких воркерах лимит чата общий для всех процессов
+        self.coordinator = coordinator
+        self._queues: Dict[int, asyncio.Queue[Tuple[str, asyncio.Future]]] = {}
+        self._buckets: Dict[int, TokenBucket] = {}
+        self._tasks: Dict[int, asyncio.Task] = {}
+        self.sent = 0
+        self.coalesced = 0
+        self.retry_after = 0
+
+    async def send_lead(self, chat_id: int, lead: Lead):
+        """Отправляет сообщение о сделке и ждет, пока оно будет доставлено"""
+        await self.send(chat_id, render_lead(lead))
+
+    async def send(self, chat_id: int, text: str):
+        """Ставит сообщение в очередь чата и ждет его отправки"""
+        future = asyncio.get_running_loop().create_future()
+        self._queue(chat_id).put_nowait((text, future))
+        await future
+
+    def _queue(self, chat_id: int) -> asyncio.Queue:
+        queue = self._queues.get(chat_id)
+        if queue is None:
+            queue = self._queues[chat_id] = asyncio.Queue()
+            self._buckets[chat_id] = (
+                self.coordinator.bucket(f"telegram:{chat_id}", self.rate, self.burst)
+                if self.coordinator is not None
+                else TokenBucket(self.rate, self.burst)
+            )
+            self._tasks[chat_id] = asyncio.create_task(self._worker(chat_id))
+        return queue
+
+    async def stop(self):
+        """Отправка оставшихся сообщений и остановка очередей"""
+        for queue in self._queues.values():
+            await queue.join()
+        for task in self._tasks.values():
+            task.cancel()
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+        self._queues, self._buckets, self._tasks = {}, {}, {}
+
+    async def _worker(self, chat_id: int):
+        queue = self._queues[chat_id]
+        bucket = self._buckets[chat_id]
+        carry = None  # Сообщение, не поместившееся в предыдущее объединенное
+        while True:
+            batch = [carry if carry is not None else await queue.get()]
+            carry = None
+            if queue.qsize() + 1 >= self.coalesce_threshold:
+                length = len(batch[0][0])
+                while not queue.empty():
+                    item = queue.get_nowait()
+                    length += len(COALESCE_SEPARATOR) + len(item[0])
+                    if length > MESSAGE_LIMIT:
+                        carry = item
+                        break
+                    batch.append(item)
+            try:
+                await self._deliver(chat_id, bucket, batch)
+            except Exception as e:
+                # Очередь чата должна работать дальше, даже если пачка не ушла
+                logger.error(f"Ошибка очереди Telegram для чата {chat_id}: {e}")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            finally:
+                for _ in batch:
+                    queue.task_done()
+
+    async def _deliver(self, chat_id: int, bucket: TokenBucket, batch):
+        text = COALESCE_SEPARATOR.join(text for text, _ in batch)
+        error: Optional[Exception] = None
+        for _ in range(self.max_attempts):
+            try:
+                # Общее ведро воркеров само обращается к хранилищу и может упасть
+                await bucket.acquire()
+            except Exception as e:
+                error = e
+                break
+            try:
+                await self.bot.send_message(chat_id, text, parse_mode="HTML")
+                error = None
+                break
+            except TelegramRetryAfter as e:
+                self.retry_after += 1
+                logger.warning(
+                    f"Telegram: превышен лимит, повтор через {e.retry_after} с"
+                )
+                bucket.pause(e.retry_after)
+                error = e
+            except Exception as e:
+                error = e
+                break
+        for _, future in batch:
+            if future.done():
+                continue
+            if error is None:
+                future.set_result(None)
+            else:
+                future.set_exception(error)
+        if error is None:
+            self.sent += 1
+            if len(batch) > 1:
+                self.coalesced += len(batch)
+        else:
+            logger.error(f"Не удалось отправить сообщение в Telegram: {error}")
+
+    def stats(self) -> dict:
+        return {
+            "queue_size": sum(q.qsize() for q in self._queues.values()),
+            "sent": self.sent,
+            "coalesced": self.coalesced,
+            "retry_after": self.retry_after,
+        }
@@ -0,0 +1,102 @@
+"""Общее состояние воркеров: блокировки, `claim` и общее ведро токенов"""
+
+import asyncio
+import time
+import pytest
+from benchmarks.fakes import InMemoryRedis
+from coordination import RedisCoordinator, SQLiteCoordinator
+
+
+@pytest.fixture(params=["sqlite", "redis"])
+def coordinators(request, tmp_path):
+    """Два координатора над одним хранилищем — как два процесса"""
+    if request.param == "sqlite":
+        path = str(tmp_path / "coordination.db")
+        pair = [SQLiteCoordinator(path), SQLiteCoordinator(path)]
+    else:
+        redis = InMemoryRedis()
+        pair = [RedisCoordinator(redis), RedisCoordinator(redis)]
+    yield pair
+    for coordinator in pair:
+        coordinator.close()
+
+
+def test_claim_is_exclusive_until_expired(coordinators):
+    first, second = coordinators
+
+    async def run():
+        assert await first.claim("recover_jobs", 0.2)
+        assert not await second.claim("recover_jobs", 0.2)
+        await asyncio.sleep(0.3)
+        assert await second.claim("recover_jobs", 0.2)
+
+    asyncio.run(run())
+
+
+def test_release_keeps_foreign_value(coordinators):
+    first, second = coordinators
+
+    async def run():
+        assert await first.claim("key", 10, "first")
+        await second.release("key", "second")
+        assert await second.get("key") == "first"
+        await first.release("key", "first")
+        assert await second.get("key") is None
+
+    asyncio.run(run())
+
+
+def test_lock_excludes_other_holders(coordinators):
+    holders = []
+
+    async def hold(coordinator, name):
+        async with coordinator.lock("sheet_rows:Лист1", ttl=5, timeout=5):
+            holders.append(name)
+            assert len(holders) == 1
+            await asyncio.sleep(0.05)
+            holders.remove(name)
+
+    async def run():
+        await asyncio.gather(
+            *(hold(c, f"{i}:{n}") for i, c in enumerate(coordinators) for n in range(3))
+        )
+
+    asyncio.run(run())
+
+
+def test_lock_timeout(coordinators):
+    first, second = coordinators
+
+    async def run():
+        async with first.lock("busy", ttl=5):
+            with pytest.raises(TimeoutError):
+                async with second.lock("busy", ttl=5, timeout=0.1):
+                    pass
+
+    asyncio.run(run())
+
+
+def test_shared_bucket_limits_all_processes(coordinators):
+    rate = 20
+
+    async def run():
+        buckets = [c.bucket("amocrm", rate, capacity=1) for c in coordinators]
+        started = time.monotonic()
+        await asyncio.gather(*(bucket.acquire() for bucket in buckets * 5))
+        return time.monotonic() - started
+
+    # 10 токенов на двоих при 20 в секунду: первый сразу, остальные через 1/20 с
+    assert asyncio.run(run()) >= 9 / rate * 0.9
+
+
+def test_shared_bucket_pause(coordinators):
+    first, second = coordinators
+
+    async def run():
+        pausing = first.bucket("telegram:1", 100)
+        other = second.bucket("telegram:1", 100)
+        pausing.pause(0.3)
+        await asyncio.sleep(0.05)  # Пауза записывается в общее состояние
+        return await other.acquire()
+
+    assert asyncio.run(run()) >= 0.2
@@ -0,0 +1,56 @@
+"""Аренда заданий `JobStore`"""
+
+import pytest
+from job_store import JobStore
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "jobs.db")
+
+
+def test_begin_takes_job_once(path):
+    first, second = JobStore(path), JobStore(path)
+    job_id = first.add(1001)
+    job = first.begin(job_id, "first", 600)
+    assert job["owner"] == "first" and job["attempts"] == 1
+    assert second.begin(job_id, "second", 600) is None
+    assert second.pending() == []
+
+
+def test_expired_lease_returns_job(path):
+    store = JobStore(path)
+    job_id = store.add(1001)
+    store.begin(job_id, "crashed", -1)
+    assert store.pending() == [job_id]
+    assert store.begin(job_id, "second", 600)["attempts"] == 2
+
+
+def test_release_and_complete(path):
+    store = JobStore(path)
+    job_id = store.add(1001)
+    store.begin(job_id, "first", 600)
+    store.release(job_id)
+    assert store.pending() == [job_id]
+    store.begin(job_id, "second", 600)
+    store.complete(job_id)
+    assert store.begin(job_id, "third", 600) is None
+    assert store.pending() == []
+
+
+def test_pending_skips_fresh_and_exhausted_jobs(path):
+    store = JobStore(path)
+    fresh = store.add(1001)
+    assert store.pending(stale=600) == []
+    store.begin(fresh, "first", -1)
+    assert store.pending(stale=600, max_attempts=1) == []
+    assert store.pending(stale=600, max_attempts=2) == [fresh]
+
+
+def test_release_others(path):
+    store = JobStore(path)
+    previous, own = store.add(1001), store.add(1002)
+    store.begin(previous, "previous run", 600)
+    store.begin(own, "current", 600)
+    assert store.release_others("current") == 1
+    assert store.pending() == [previous]
@@ -0,0 +1,124 @@
+"""Опрос событий AmoCRM и курсор `EventPoller` на заглушке AmoCRM"""
+
+import asyncio
+import pytest
+from amocrm import AmoCRMClient
+from benchmarks.fakes import FakeAmoCRM
+from coordination import SQLiteCoordinator
+from poller import EventPoller
+
+
+def poll_scenario(tmp_path, scenario, coordinator=None):
+    """Запускает `scenario(amo, poller, handled)` с клиентом на заглушке"""
+
+    async def run():
+        amo = await FakeAmoCRM(latency=0).start()
+        client = AmoCRMClient(
+            amo.url, "token", permanent_access_token=True, rate_limit=1000
+        )
+        client.start_session()
+        handled = []
+
+        async def handle(statuses):
+            handled.append([int(status["id"]) for status in statuses])
+
+        poller = EventPoller(
+            client,
+            handle,
+            cursor_path=str(tmp_path / "events_cursor.json"),
+            settle_delay=0,
+            coordinator=coordinator,
+        )
+        try:
+            await scenario(amo, poller, handled)
+        finally:
+            await client.close_session()
+            await amo.stop()
+
+    asyncio.run(run())
+
+
+def test_first_poll_skips_history(tmp_path):
+    async def scenario(amo, poller, handled):
+        amo.add_event(1)
+        assert await poller.poll() == 0
+        assert handled == []
+
+    poll_scenario(tmp_path, scenario)
+
+
+def test_new_events_are_handled_once_in_order(tmp_path):
+    async def scenario(amo, poller, handled):
+        await poller.poll()
+        for lead_id in (11, 12, 13):
+            amo.add_event(lead_id)
+        assert await poller.poll() == 3
+        assert handled == [[11, 12, 13]]
+        # События той же секунды остаются в курсоре и не приходят повторно
+        assert await poller.poll() == 0
+        amo.add_event(14)
+        assert await poller.poll() == 1
+        assert handled == [[11, 12, 13], [14]]
+
+    poll_scenario(tmp_path, scenario)
+
+
+def test_events_from_all_pages(tmp_path):
+    async def scenario(amo, poller, handled):
+        await poller.poll()
+        for lead_id in range(150):
+            amo.add_event(lead_id)
+        assert await poller.poll() == 150
+        assert handled == [list(range(150))]
+        assert amo.calls["events"] >= 2
+
+    poll_scenario(tmp_path, scenario)
+
+
+def test_failed_handle_keeps_cursor(tmp_path):
+    async def scenario(amo, poller, handled):
+        await poller.poll()
+        amo.add_event(21)
+        handle = poller.handle
+
+        async def failing(statuses):
+            raise RuntimeError("очередь недоступна")
+
+        poller.handle = failing
+        with pytest.raises(RuntimeError):
+            await poller.poll()
+        poller.handle = handle
+        assert await poller.poll() == 1
+        assert handled == [[21]]
+
+    poll_scenario(tmp_path, scenario)
+
+
+def test_cursor_survives_restart(tmp_path):
+    async def first_run(amo, poller, handled):
+        await poller.poll()
+
+    async def second_run(amo, poller, handled):
+        # Курсор из прошлого запуска: история не пропускается повторно
+        amo.add_event(31)
+        assert await poller.poll() == 1
+        assert handled == [[31]]
+
+    poll_scenario(tmp_path, first_run)
+    poll_scenario(tmp_path, second_run)
+
+
+def test_cursor_in_shared_state(tmp_path):
+    coordinator = SQLiteCoordinator(str(tmp_path / "coordination.db"))
+
+    async def scenario(amo, poller, handled):
+        await poller.poll()
+        amo.add_event(41)
+        await poller.poll()
+        assert await coordinator.get("events_cursor")
+
+    try:
+        poll_scenario(tmp_path, scenario, coordinator)
+    finally:
+        coordinator.close()
+    assert not (tmp_path / "events_cursor.json").exists()